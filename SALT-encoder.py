@@ -1,16 +1,31 @@
 import sys
 import re
 import csv
+import bisect
+import itertools
+import multiprocessing
 import os.path
 
 SALT_CHARS = """ !"#$%&'()*+,-./0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\]^_`abcdefghijklmnopqrstuvwxyz{|}~"""
 
+# Format is "MM:SS SUPPLY ACTION"
+pattern = re.compile("(\d\d):(\d\d) (\d+) (.+)")
+
 def main(args):
     helpstring = """
     Takes one argument: a text file of human-readable output from https://burnysc2.github.io/sc2-planner/
-    Takes two options: -a <author> and -d <description>
+    Takes three options: -a <author>, -d <description> and -m <salt map>
+    The salt map defaults to $SALT_MAP, else salt_map.tsv next to this script,
+    else /home/pwoods/static/salt_map.tsv.
     Build order name is taken from the input file name.
     Outputs a SALT string containing the specified build order to stdout.
+
+    Batch mode: given several files, a directory or - for stdin, outputs one
+    "build<TAB>SALT" line per build order instead. Build orders on stdin are
+    separated by blank lines, and a line "# name" before one names it.
+    Use -j <n> to encode with n worker processes.
+    Lines that can't be parsed are reported on stderr and that build order
+    is skipped; the exit status is 1 if any were.
     SALT documentation found at https://drive.google.com/file/d/0Bzrw_bC8iBjfSzFRRGlWWnNWNDg/view
     Last updated 15 August 2020
     """
@@ -21,49 +36,181 @@ def main(args):
     # Allow optional flags -a and -d for specifying author and description
     author = ""
     desc = ""
-    while len(args) > 0 and args[0][0] == "-":
+    salt_map = os.environ.get("SALT_MAP")
+    if salt_map is None:
+        salt_map = os.path.join(os.path.dirname(os.path.abspath(__file__)), "salt_map.tsv")
+        if not os.path.exists(salt_map):
+            salt_map = "/home/pwoods/static/salt_map.tsv"
+    jobs = 1
+    while len(args) > 0 and args[0][0] == "-" and args[0] != "-":
         arg = args.pop(0)
         if arg == "-a":
             author = args.pop(0)
         elif arg == "-d":
             desc = args.pop(0)
-    if len(args) != 1:
-        print("This script requires exactly one positional input. Use the --help option for more information.")
+        elif arg == "-m":
+            salt_map = args.pop(0)
+        elif arg == "-j":
+            jobs = int(args.pop(0))
+    if len(args) == 0:
+        print("This script requires at least one positional input. Use the --help option for more information.")
+        sys.exit(1)
+    try:
+        salt_table = SaltMap(salt_map)
+    except OSError as e:
+        print("Could not open the salt map {}: {}. Use -m or $SALT_MAP to give its location.".format(salt_map, e.strerror))
         sys.exit(1)
-    filename = args.pop(0)
 
-    # Build name taken from file name
-    build = filename.split(".")[0].strip().replace(" ","_")
+    if len(args) == 1 and os.path.isfile(args[0]):
+        filename = args[0]
+        # Build name taken from file name
+        build = filename.split(".")[0].strip().replace(" ","_")
+        with open(filename, 'r') as f:
+            try:
+                SALT_string = encodeBuild(f, build, author, desc, salt_table)
+            except ValueError as e:
+                print("{}: {}".format(filename, e), file=sys.stderr)
+                sys.exit(1)
+        # Finished constructing the string
+        print(SALT_string)
+    else:
+        encodeBatch(args, author, desc, salt_table, jobs)
+
+def encodeBuild(lines, build, author, desc, salt_table):
+    """Returns the SALT string for the build order in lines, or raises ValueError on a bad line"""
     SALT_string = "%{build}|{author}|{description}|~".format(build=build, author=author, description=desc)
-    # Format is "MM:SS SUPPLY ACTION"
-    pattern = re.compile("(\d\d):(\d\d) (\d+) (.+)")
-
-    with open(filename, 'r') as f:
-        for line in f:
-            match = pattern.match(line)
-            mins, secs, supply, action = match.groups()
-            # Several BurnySC events don't have SALT counterparts
-            if "MULE" in action or "3x Mine gas" in action or "Lift" in action or "to free" in action:
-                continue
-            mins = encodeNumber(int(mins))
-            secs = encodeNumber(int(secs))
-            supply = encodeSupply(int(supply))
-            eventType = None
-            itemID = None
-            # Get path to data file
-            salt_map = "/home/pwoods/static/salt_map.tsv"
-            with open(salt_map, 'r') as salt_table:
-                reader = csv.DictReader(salt_table, delimiter='\t')
-                # Format of the table file is type, item_id, salt_name, burny_name
-                for row in reader:
-                    # Burny specifies upgrades as (.*)Level\d but we only want to match with \1
-                    if row['burny_name'].startswith(action.strip().split("Level")[0]):
-                        eventType = encodeNumber(int(row['type']))
-                        itemID = encodeNumber(int(row['item_id']))
-            SALT_event = "{supply}{minutes}{seconds}{typeid}{itemid}".format(supply=supply, minutes=mins, seconds=secs, typeid=eventType, itemid=itemID)
-            SALT_string += SALT_event
-    # Finished constructing the string
-    print(SALT_string)
+    for lineno, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        match = pattern.match(line)
+        if match is None:
+            raise ValueError("line {}: not a build order event: {!r}".format(lineno, line.rstrip("\n")))
+        mins, secs, supply, action = match.groups()
+        # Several BurnySC events don't have SALT counterparts
+        if "MULE" in action or "3x Mine gas" in action or "Lift" in action or "to free" in action:
+            continue
+        mins = encodeNumber(int(mins))
+        secs = encodeNumber(int(secs))
+        supply = encodeSupply(int(supply))
+        eventType = None
+        itemID = None
+        entry = salt_table.lookup(action)
+        if entry is not None:
+            eventType = encodeNumber(entry[0])
+            itemID = encodeNumber(entry[1])
+        SALT_event = "{supply}{minutes}{seconds}{typeid}{itemid}".format(supply=supply, minutes=mins, seconds=secs, typeid=eventType, itemid=itemID)
+        SALT_string += SALT_event
+    return SALT_string
+
+def encodeBatch(inputs, author, desc, salt_table, jobs):
+    """
+    Encodes every build order in inputs (files, directories or - for
+    stdin), printing "build<TAB>SALT" lines in input order. Worker
+    processes get the parsed salt map once, when they start.
+    """
+    builds = readBuilds(inputs)
+    failed = False
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, initializer=initWorker, initargs=(salt_table, author, desc))
+        results = pool.imap(encodeJob, builds, chunksize=16)
+    else:
+        initWorker(salt_table, author, desc)
+        results = map(encodeJob, builds)
+    for source, build, SALT_string, error in results:
+        if error is not None:
+            print("{}: {}".format(source, error), file=sys.stderr)
+            failed = True
+        else:
+            print("{}\t{}".format(build, SALT_string), flush=True)
+    if jobs > 1:
+        pool.close()
+        pool.join()
+    if failed:
+        sys.exit(1)
+
+def readBuilds(inputs):
+    """
+    Yields (source, build, lines) for each build order. Files are read
+    by the worker, so lines is None for them.
+    """
+    for name in inputs:
+        if name == "-":
+            yield from readStream(sys.stdin)
+        elif os.path.isdir(name):
+            for entry in sorted(os.listdir(name)):
+                path = os.path.join(name, entry)
+                if os.path.isfile(path):
+                    yield path, buildName(path), None
+        else:
+            yield name, buildName(name), None
+
+def readStream(stream):
+    """Splits a stream into build orders at blank lines; "# name" lines name the next one"""
+    count = 0
+    build = None
+    lines = []
+    for line in itertools.chain(stream, [""]):
+        if line.startswith("#"):
+            build = line[1:].strip().replace(" ","_")
+        elif line.strip():
+            lines.append(line)
+        elif lines:
+            count += 1
+            build = build or "build{}".format(count)
+            yield "stdin build {}".format(build), build, lines
+            build = None
+            lines = []
+
+def buildName(path):
+    # Build name taken from file name
+    return os.path.basename(path).split(".")[0].strip().replace(" ","_")
+
+# Set in each worker process by initWorker
+worker_state = None
+
+def initWorker(salt_table, author, desc):
+    global worker_state
+    worker_state = (salt_table, author, desc)
+
+def encodeJob(job):
+    source, build, lines = job
+    salt_table, author, desc = worker_state
+    try:
+        if lines is None:
+            with open(source, 'r') as f:
+                return source, build, encodeBuild(f, build, author, desc, salt_table), None
+        return source, build, encodeBuild(lines, build, author, desc, salt_table), None
+    except (OSError, ValueError) as e:
+        return source, build, None, str(e)
+
+class SaltMap:
+    """
+    The salt map table, indexed by burny_name so each lookup is a binary
+    search rather than a scan of the whole file. Format of the table file
+    is type, item_id, salt_name, burny_name.
+    """
+    def __init__(self, path):
+        with open(path, 'r') as salt_table:
+            rows = list(csv.DictReader(salt_table, delimiter='\t'))
+        # Sorted by name; the row number breaks ties and lets the last match win
+        self.rows = sorted((row['burny_name'], i, int(row['type']), int(row['item_id'])) for i, row in enumerate(rows))
+        self.names = [row[0] for row in self.rows]
+        self.cache = {}
+
+    def lookup(self, action):
+        """
+        Returns (type, item_id) of the last row in the file whose burny_name
+        starts with the action, or None if there isn't one
+        """
+        # Burny specifies upgrades as (.*)Level\d but we only want to match with \1
+        prefix = action.strip().split("Level")[0]
+        if prefix not in self.cache:
+            # Every name starting with prefix sorts between these two points
+            start = bisect.bisect_left(self.names, prefix)
+            end = bisect.bisect_left(self.names, prefix + chr(sys.maxunicode), start)
+            matches = self.rows[start:end]
+            self.cache[prefix] = max(matches, key=lambda row: row[1])[2:] if matches else None
+        return self.cache[prefix]
 
 def encodeNumber(i):
     if i >= len(SALT_CHARS):
@@ -1,16 +1,40 @@
 #!/usr/bin/env python
 import os
 import sys
+import glob
+import json
+import pickle
+import hashlib
+import tempfile
+import difflib
+import itertools
 import numpy as np
 import pandas as pd
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+# Parsed template sheets, set once in each batch worker by init_worker
+template_sheets = None
 
 def main(args):
-    template_sheets = pd.read_excel(args.template, sheet_name=None, header=None)
-    test_sheets = pd.read_excel(args.test, sheet_name=None, header=None)
+    if args.batch:
+        batch_compare(args)
+        return
+    if args.stream:
+        stream_compare(args)
+        return
+    if args.jobs > 1:
+        # Workers read their own sheets, so only the names are needed here
+        with pd.ExcelFile(args.template) as f:
+            template_keys = f.sheet_names
+        with pd.ExcelFile(args.test) as f:
+            test_keys = f.sheet_names
+    else:
+        template_sheets = pd.read_excel(args.template, sheet_name=None, header=None)
+        test_sheets = pd.read_excel(args.test, sheet_name=None, header=None)
 
-    template_keys = template_sheets.keys()
-    test_keys = test_sheets.keys()
+        template_keys = template_sheets.keys()
+        test_keys = test_sheets.keys()
 
     print("="*40)
     print("Comparing sheet names")
@@ -26,38 +50,342 @@ def main(args):
         print("Sheet names match.")
     print("="*40)
 
-    for sheet in template_keys:
+    if args.jobs > 1:
+        n = len(template_keys)
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            # map() yields results in sheet order even if workers finish out of order
+            report_differences(template_keys, pool.map(compare_sheet, [args.template]*n, [args.test]*n, template_keys,
+                                                        [args.tolerance]*n, [args.align_rows]*n))
+    else:
+        report_differences(template_keys, (compare_frames(template_sheets[sheet], test_sheets[sheet], args.tolerance, args.align_rows)
+                                           for sheet in template_keys))
+
+def report_differences(sheets, differences):
+    """Print the compare_frames result of each sheet, in sheet order"""
+    for sheet, (difference_df, deleted, inserted) in zip(sheets, differences):
         print("="*40)
         print("Comparing sheet '{}'".format(sheet))
         print("-"*40)
-        template_df = template_sheets[sheet]
-        test_df = test_sheets[sheet]
-        difference_df = pd.DataFrame(columns=["Row", "Column", "Template", "Test"])
-        # Iterate through cells in the sheet
-        rtemplate,ctemplate = template_df.shape
-        rtest,ctest = test_df.shape
-        for row in range(max(rtemplate, rtest)):
-            for col in range(max(ctemplate, ctest)):
-                # Get cell value in template
-                try:
-                    template_val = template_df.iloc[row,col]
-                except:
-                    template_val = np.nan
-                # Get cell value in test
-                try:
-                    test_val = test_df.iloc[row,col]
-                except:
-                    test_val = np.nan
-                # Compare the cell values
-                if str(template_val) != str(test_val):
-                    tmp_df = pd.DataFrame([[row, col, template_val, test_val]], columns=["Row", "Column", "Template", "Test"])
-                    difference_df = pd.concat([difference_df, tmp_df], ignore_index=True)
-        if difference_df.empty:
+        if deleted:
+            print("Template rows missing from test: {}".format(", ".join(str(r) for r in deleted)))
+        if inserted:
+            print("Test rows not in template: {}".format(", ".join(str(r) for r in inserted)))
+        if difference_df.empty and not (deleted or inserted):
             print("NO DIFFERENCE IN DATA")
-        else:
+        elif not difference_df.empty:
             print(difference_df.to_string(index=False))
         print("="*40)
 
+def compare_sheet(template, test, sheet, tolerance=None, align_rows=False):
+    """
+    Read one sheet from both documents and return compare_frames for it.
+    Runs in a worker process when --jobs is more than 1.
+    """
+    template_df = pd.read_excel(template, sheet_name=sheet, header=None)
+    test_df = pd.read_excel(test, sheet_name=sheet, header=None)
+    return compare_frames(template_df, test_df, tolerance, align_rows)
+
+def compare_frames(template_df, test_df, tolerance=None, align_rows=False):
+    """
+    Compare two sheets, skipping the cell comparison when their row
+    hashes show they are identical.
+
+    Returns
+    -------
+    tuple
+        The difference table, and the lists of deleted template rows and
+        inserted test rows (always empty unless align_rows is set)
+    """
+    width = max(template_df.shape[1], test_df.shape[1])
+    template_hashes = row_hashes(template_df, width)
+    test_hashes = row_hashes(test_df, width)
+    if np.array_equal(template_hashes, test_hashes):
+        return diff_frames(template_df.iloc[:0], test_df.iloc[:0]), [], []
+    if align_rows:
+        return align_frames(template_df, test_df, template_hashes, test_hashes, tolerance)
+    return diff_frames(template_df, test_df, tolerance), [], []
+
+def row_hashes(df, width):
+    """
+    Hash of each row's cells in string form, padded with NaN to `width`
+    columns, so rows that diff_frames treats as equal hash the same
+    """
+    values = padded_values(df, (df.shape[0], width)).astype(str)
+    return pd.util.hash_pandas_object(pd.DataFrame(values), index=False).to_numpy()
+
+def align_frames(template_df, test_df, template_hashes, test_hashes, tolerance=None):
+    """
+    Match rows between two sheets with a diff of their row hashes, so an
+    inserted or deleted row doesn't shift every row below it. Only rows
+    paired up inside changed blocks are compared cell by cell.
+
+    Returns
+    -------
+    tuple
+        Difference table with Template Row and Test Row columns in place
+        of Row, the template rows missing from test, and the test rows
+        missing from the template
+    """
+    matcher = difflib.SequenceMatcher(None, template_hashes.tolist(), test_hashes.tolist(), autojunk=False)
+    deleted, inserted, template_rows, test_rows = [], [], [], []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        # Pair up rows of a changed block in order; the rest are deletes or inserts
+        paired = min(i2 - i1, j2 - j1)
+        template_rows.extend(range(i1, i1 + paired))
+        test_rows.extend(range(j1, j1 + paired))
+        deleted.extend(range(i1 + paired, i2))
+        inserted.extend(range(j1 + paired, j2))
+    differences = diff_frames(template_df.iloc[template_rows].reset_index(drop=True),
+                              test_df.iloc[test_rows].reset_index(drop=True), tolerance)
+    pairs = differences.pop("Row").to_numpy(dtype=np.int64)
+    differences.insert(0, "Test Row", np.array(test_rows, dtype=np.int64)[pairs].astype(object))
+    differences.insert(0, "Template Row", np.array(template_rows, dtype=np.int64)[pairs].astype(object))
+    return differences, deleted, inserted
+
+def diff_frames(template_df, test_df, tolerance=None):
+    """
+    Find the cells that differ between two sheets.
+
+    Parameters
+    ----------
+    template_df : pandas.core.frame.DataFrame
+        Sheet read from the template, with header=None
+    test_df : pandas.core.frame.DataFrame
+        The same sheet read from the test document
+    tolerance : float, optional
+        If given, cells that are numeric in both sheets count as equal
+        when they differ by no more than this amount
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        One row per differing cell with columns Row, Column, Template and
+        Test. Cells are compared by their string form, and cells outside a
+        sheet count as NaN, so an empty cell matches a missing one.
+    """
+    # Pad both sheets to the same shape; cells outside a sheet become NaN
+    shape = (max(template_df.shape[0], test_df.shape[0]), max(template_df.shape[1], test_df.shape[1]))
+    template = padded_values(template_df, shape)
+    test = padded_values(test_df, shape)
+    mask = template.astype(str) != test.astype(str)
+    if tolerance is not None:
+        template_num = pd.to_numeric(pd.Series(template.ravel()), errors='coerce').to_numpy(dtype=float).reshape(shape)
+        test_num = pd.to_numeric(pd.Series(test.ravel()), errors='coerce').to_numpy(dtype=float).reshape(shape)
+        with np.errstate(invalid='ignore'):
+            mask &= ~(np.abs(template_num - test_num) <= tolerance)
+    rows, cols = np.nonzero(mask)
+    # Object columns keep the table layout the same as before
+    return pd.DataFrame({"Row": rows, "Column": cols, "Template": template[rows, cols], "Test": test[rows, cols]}, dtype=object)
+
+def batch_compare(args):
+    """
+    Compare every workbook matched by args.batch against the template.
+    The template is parsed once (or loaded from the cache) and handed to
+    each worker when it starts. Prints one JSON summary line per test
+    workbook and writes the differing cells to args.output, if given.
+    Exits with status 1 if any workbook differs or can't be read.
+    """
+    paths = [path for pattern in args.batch for path in workbook_paths(pattern)]
+    if not paths:
+        sys.exit("No test workbooks found.")
+    template = read_template_cached(args.template, args.cache_dir)
+    records = []
+    failed = False
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker, initargs=(template,)) as pool:
+        n = len(paths)
+        for summary, file_records in pool.map(compare_workbook, paths, [args.tolerance]*n, [args.align_rows]*n):
+            print(json.dumps(summary), flush=True)
+            failed |= summary["status"] != "pass"
+            records.extend(file_records)
+    if args.output:
+        write_records(records, args.output)
+    if failed:
+        sys.exit(1)
+
+def workbook_paths(pattern):
+    """Returns the Excel files in a directory, or the files matching a glob pattern"""
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.xls*')
+    return sorted(f for f in glob.glob(pattern) if os.path.isfile(f))
+
+def read_template_cached(path, cache_dir):
+    """
+    All sheets of the template, read with header=None. If `cache_dir` is
+    given, the parsed sheets are pickled there, keyed on the template's
+    path, size and mtime, so later runs against an unchanged template
+    skip parsing it.
+    """
+    if cache_dir is None:
+        return pd.read_excel(path, sheet_name=None, header=None)
+    st = os.stat(path)
+    source = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+    version = hashlib.sha1(repr((st.st_size, st.st_mtime_ns)).encode()).hexdigest()[:16]
+    cached = os.path.join(cache_dir, '{}-{}.pkl'.format(source, version))
+    try:
+        with open(cached, 'rb') as f:
+            return pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        pass
+    sheets = pd.read_excel(path, sheet_name=None, header=None)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Drop copies made from older versions of the template
+    for old in glob.glob(os.path.join(cache_dir, source + '-*.pkl')):
+        try:
+            os.remove(old)
+        except FileNotFoundError:
+            pass
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(sheets, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, cached)
+    return sheets
+
+def init_worker(template):
+    global template_sheets
+    template_sheets = template
+
+def compare_workbook(path, tolerance=None, align_rows=False):
+    """
+    Compare one test workbook against the worker's template sheets.
+
+    Returns
+    -------
+    tuple
+        A summary dict with the file, its status ("pass", "fail" or
+        "error") and the number of differences, and a list of diff
+        records, one per differing cell or unmatched row
+    """
+    summary = {"file": path, "status": "pass", "differences": 0}
+    try:
+        test_sheets = pd.read_excel(path, sheet_name=None, header=None)
+    except Exception as e:
+        summary.update(status="error", error="{}: {}".format(type(e).__name__, e))
+        return summary, []
+    if set(template_sheets) != set(test_sheets):
+        summary.update(status="fail", error="Mismatched sheet names",
+                       template_sheets=list(template_sheets), test_sheets=list(test_sheets))
+        return summary, []
+    records = []
+    for sheet in template_sheets:
+        difference_df, deleted, inserted = compare_frames(template_sheets[sheet], test_sheets[sheet],
+                                                          tolerance, align_rows)
+        records.extend(diff_records(path, sheet, difference_df, deleted, inserted))
+    if records:
+        summary.update(status="fail", differences=len(records))
+    return summary, records
+
+def diff_records(path, sheet, difference_df, deleted, inserted):
+    """Turns the output of compare_frames into one dict per change"""
+    aligned = "Template Row" in difference_df
+    template_rows = difference_df["Template Row" if aligned else "Row"]
+    test_rows = difference_df["Test Row" if aligned else "Row"]
+    for template_row, test_row, col, template_val, test_val in zip(
+            template_rows, test_rows, difference_df["Column"], difference_df["Template"], difference_df["Test"]):
+        yield {"file": path, "sheet": sheet, "change": "cell", "template_row": int(template_row),
+               "test_row": int(test_row), "column": int(col),
+               "template": json_value(template_val), "test": json_value(test_val)}
+    for row in deleted:
+        yield {"file": path, "sheet": sheet, "change": "deleted", "template_row": row, "test_row": None,
+               "column": None, "template": None, "test": None}
+    for row in inserted:
+        yield {"file": path, "sheet": sheet, "change": "inserted", "template_row": None, "test_row": row,
+               "column": None, "template": None, "test": None}
+
+def json_value(value):
+    # NaN marks an empty cell; numpy scalars and dates need converting for json
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (int, float, str, bool)):
+        return value
+    return str(value)
+
+def write_records(records, path):
+    """Writes diff records as Parquet if path ends in .parquet, otherwise as JSON lines"""
+    if path.endswith('.parquet'):
+        df = pd.DataFrame(records, columns=["file", "sheet", "change", "template_row", "test_row",
+                                            "column", "template", "test"])
+        # Cell values mix types, so store their string form
+        for col in ["template", "test"]:
+            df[col] = df[col].map(lambda v: None if v is None else str(v))
+        for col in ["template_row", "test_row", "column"]:
+            df[col] = df[col].astype('Int64')
+        df.to_parquet(path, index=False)
+    else:
+        with open(path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+
+def stream_compare(args):
+    """
+    Compare two .xlsx workbooks row by row without loading either into
+    memory. Differences are printed as soon as they are found, one
+    tab-separated line per cell.
+    """
+    from openpyxl import load_workbook
+    template_wb = load_workbook(args.template, read_only=True, data_only=True)
+    test_wb = load_workbook(args.test, read_only=True, data_only=True)
+    print("="*40)
+    print("Comparing sheet names")
+    print("-"*40)
+    if set(template_wb.sheetnames) != set(test_wb.sheetnames):
+        err = """
+        Mismatched sheet names:
+        Template: {0}
+        Test:     {1}
+        """. format(",".join(template_wb.sheetnames), ",".join(test_wb.sheetnames))
+        sys.exit(err)
+    else:
+        print("Sheet names match.")
+    print("="*40)
+    for sheet in template_wb.sheetnames:
+        print("="*40)
+        print("Comparing sheet '{}'".format(sheet))
+        print("-"*40)
+        found = False
+        rows = itertools.zip_longest(template_wb[sheet].iter_rows(values_only=True),
+                                     test_wb[sheet].iter_rows(values_only=True), fillvalue=())
+        for row, (template_row, test_row) in enumerate(rows):
+            cells = itertools.zip_longest(template_row, test_row, fillvalue=None)
+            for col, (template_val, test_val) in enumerate(cells):
+                if cells_differ(template_val, test_val, args.tolerance):
+                    if not found:
+                        print("Row\tColumn\tTemplate\tTest")
+                        found = True
+                    print("{}\t{}\t{}\t{}".format(row, col, as_cell(template_val), as_cell(test_val)), flush=True)
+        if not found:
+            print("NO DIFFERENCE IN DATA")
+        print("="*40)
+    template_wb.close()
+    test_wb.close()
+
+def as_cell(value):
+    # Empty cells read as None; show them as NaN like the pandas comparison
+    return np.nan if value is None else value
+
+def as_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def cells_differ(template_val, test_val, tolerance=None):
+    """Single-cell version of the comparison made by diff_frames"""
+    template_val, test_val = as_cell(template_val), as_cell(test_val)
+    if str(template_val) == str(test_val):
+        return False
+    if tolerance is not None:
+        return not abs(as_number(template_val) - as_number(test_val)) <= tolerance
+    return True
+
+def padded_values(df, shape):
+    values = np.full(shape, np.nan, dtype=object)
+    values[:df.shape[0], :df.shape[1]] = df.to_numpy(dtype=object)
+    return values
+
 if __name__ == "__main__":
     desc = ("Compares two Excel documents to identify differences in cell values. Works "
             "best when the documents are highly similar. The output shows a table of the "
@@ -65,6 +393,15 @@ if __name__ == "__main__":
             "indicate an empty cell in that sheet.")
     parser = argparse.ArgumentParser(description=desc)
     parser.add_argument("template", help="Template Excel document to test against.")
-    parser.add_argument("test", help="Document which may or may not be equal to the template.")
+    parser.add_argument("test", nargs='?', help="Document which may or may not be equal to the template.")
+    parser.add_argument("--stream", action='store_true', help="Read both .xlsx documents row by row in read-only mode and print differences as they are found. Memory use depends on row width rather than workbook size.")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Compare this many sheets at once in separate processes. Default: 1")
+    parser.add_argument("--align-rows", action='store_true', help="Match rows between the documents before comparing cells, so inserted and deleted rows are reported as such instead of shifting every row below them.")
+    parser.add_argument("--tolerance", type=float, help="Treat numeric cells as equal if they differ by no more than this amount.")
+    parser.add_argument("--batch", nargs='+', metavar="PATH", help="Compare every workbook in these directories or matching these glob patterns against the template instead of a single test document. Prints one JSON summary line per workbook and exits with status 1 if any differ.")
+    parser.add_argument("-o", "--output", help="With --batch, write one record per difference to this file, as Parquet if it ends in .parquet and JSON lines otherwise.")
+    parser.add_argument("--cache-dir", default=os.environ.get("COMPARE_EXCEL_CACHE"), help="With --batch, keep the parsed template here so later runs against an unchanged template skip reading it. Default: $COMPARE_EXCEL_CACHE, else no cache")
     args = parser.parse_args()
+    if (args.test is None) == (args.batch is None):
+        parser.error("give either a test document or --batch, but not both")
     main(args)
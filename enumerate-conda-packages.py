@@ -1,55 +1,582 @@
 #!/usr/bin/env python
 import os
+import re
 import sys
+import math
+import glob
 import json
+import sqlite3
+import shutil
 import argparse
+import itertools
 import pandas as pd
 import subprocess as sp
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    from conda.models.version import VersionOrder
+except ImportError:
+    VersionOrder = None
 
 # Is there a decent way to check for manually installed packages like the prot_loc one on ocean?
 # Maybe compare this output to a list of the things in $CONDA_PREFIX/bin?
 
 def main(args):
-    # Get list of env prefixes
-    print("Gathering list of environments...")
-    env_json = sp.run(['conda', 'info', '--envs', '--json'], capture_output=True, text=True).stdout
-    env_prefixes = json.loads(env_json)['envs']
-    output_records = []
-    error_messages = []
-    for index, prefix in enumerate(env_prefixes, start=1):
-        # Get env name from env prefix
-        if prefix.count('env') == 0:
-            env_name = "base"
-        else:
-            env_name = os.path.basename(prefix)
-        # Get package info
-        print("Enumerating packages in env: {name} ({index} of {total})".format(name=env_name, index=index, total=len(env_prefixes)))
-        pkg_json = sp.run(['conda', 'list', '--json', '-p', prefix], capture_output=True, text=True).stdout
-        pkgs_obj = json.loads(pkg_json)
-        # Detect conda errors
-        if isinstance(pkgs_obj, dict) and 'error' in pkgs_obj.keys():
-            error_messages.append(prefix['error'])
-            continue
-        # Create package records for output
-        for pkg in pkgs_obj:
-            record = {
-                    'package': pkg['name'],
-                    'version': pkg['version'],
-                    'env': env_name,
-                    'channel': pkg['channel']
-                    }
-            output_records.append(record)
+    if args.command is not None:
+        if args.store is None:
+            sys.exit("The {} command needs an inventory store; use --store or set $CONDA_INVENTORY_DB.".format(args.command))
+        with open_store(args.store) as db:
+            {'query': query_store, 'diff': diff_snapshots, 'snapshots': list_snapshots}[args.command](db, args)
+        return
+    cache = None if args.cache is None else load_cache(args.cache)
+    if args.cli:
+        env_prefixes, reader = cli_environments(), list_packages
+    else:
+        # Get list of env prefixes
+        print("Gathering list of environments...")
+        env_prefixes, reader = find_environments(args.conda_root, args.envs_dir), read_conda_meta
+        if not env_prefixes:
+            print("No conda installation found on disk, falling back to the conda CLI.")
+            env_prefixes, reader = cli_environments(), list_packages
+    output_records, error_messages = enumerate_environments(env_prefixes, reader, args.jobs, cache, args.refresh)
+    if cache is not None:
+        save_cache(args.cache, cache, env_prefixes)
+    if args.check:
+        cli_records, _ = enumerate_environments(cli_environments(), list_packages, args.jobs)
+        error_messages.extend(compare_records(output_records, cli_records))
     # Create DataFrame for output formatting
     print("Formatting output file(s)...")
-    out = pd.DataFrame.from_records(output_records)
-    out.sort_values(by=['package', 'env'], inplace=True)
+    out = pd.DataFrame.from_records(output_records, columns=['package', 'version', 'env', 'channel', 'build'])
+    if args.disk_usage:
+        print("Measuring disk usage...")
+        package_usage, env_usage = disk_usage(env_prefixes, args.jobs)
+        keys = list(zip(out['env'], out['package']))
+        out['unique_bytes'] = [package_usage.get(key, (0, 0))[0] for key in keys]
+        out['shared_bytes'] = [package_usage.get(key, (0, 0))[1] for key in keys]
+        out['env_unique_bytes'] = [env_usage.get(env, (0, 0))[0] for env in out['env']]
+        out['env_shared_bytes'] = [env_usage.get(env, (0, 0))[1] for env in out['env']]
+        for env, (unique, shared) in sorted(env_usage.items()):
+            print("    {}: {:.1f} MiB unique, {:.1f} MiB shared".format(env, unique / 2**20, shared / 2**20))
+    out.sort_values(by=['package', 'env'], inplace=True, kind='mergesort')
     out.to_csv(args.output, sep='\t', index=False)
     if args.excel:
         out.to_excel(args.excel, index=False, freeze_panes=(1,0), autofilter=True)
+    if args.store is not None:
+        with open_store(args.store) as db:
+            snapshot, added, removed = record_snapshot(db, output_records)
+        print("Recorded snapshot {} in {}: {} package record(s) added, {} removed.".format(snapshot, args.store, added, removed))
     if error_messages:
         print("The following exceptions were encountered during execution:")
         for message in error_messages:
             print(message)
+        if args.check:
+            sys.exit(1)
+
+def enumerate_environments(env_prefixes, reader, jobs, cache=None, refresh=False):
+    """
+    Runs reader on each prefix with up to `jobs` at once. Returns the
+    package records in prefix order and any error messages.
+
+    If a cache dict is given, environments whose change markers match
+    their cache entry are served from it instead, unless refresh is set,
+    and the entries of rescanned environments are updated.
+    """
+    output_records = []
+    error_messages = []
+    rescanned = []
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(scan_environment, prefix, reader, cache, refresh): prefix for prefix in env_prefixes}
+        # Report progress as environments finish, but keep results in prefix order
+        for index, future in enumerate(as_completed(futures), start=1):
+            source = " from cache" if future.result()[2] else ""
+            print("Enumerated packages in env{source}: {name} ({index} of {total})".format(source=source, name=env_name(futures[future]), index=index, total=len(env_prefixes)))
+        for future, prefix in futures.items():
+            records, error, cached = future.result()
+            if error is not None:
+                error_messages.append(error)
+            if not cached:
+                rescanned.append(prefix)
+            output_records.extend(records)
+    if cache is not None:
+        print("Rescanned {} environment(s), {} served from cache.".format(len(rescanned), len(env_prefixes) - len(rescanned)))
+        for prefix in rescanned:
+            print("    rescanned: {}".format(prefix))
+    return output_records, error_messages
+
+def scan_environment(prefix, reader, cache=None, refresh=False):
+    """Returns (records, error, cached) for one environment, using the cache when it is current"""
+    if cache is None:
+        return reader(prefix) + (False,)
+    signature = env_signature(prefix, reader.__name__)
+    entry = cache.get(prefix)
+    if not refresh and signature is not None and entry is not None and entry['signature'] == signature:
+        return entry['records'], None, True
+    records, error = reader(prefix)
+    if error is None and signature is not None:
+        cache[prefix] = {'signature': signature, 'records': records}
+    return records, error, False
+
+def env_signature(prefix, reader_name):
+    """
+    Cheap change marker for an environment: conda rewrites
+    conda-meta/history on every transaction, and adding or removing a
+    package changes the conda-meta directory's mtime. pip only touches
+    site-packages, so the mtimes of those directories are included too.
+    None if the prefix has no conda-meta.
+    """
+    meta = os.path.join(prefix, 'conda-meta')
+    try:
+        meta_st = os.stat(meta)
+    except OSError:
+        return None
+    try:
+        history_st = os.stat(os.path.join(meta, 'history'))
+        history = [history_st.st_size, history_st.st_mtime_ns]
+    except OSError:
+        history = None
+    site_packages = [os.stat(path).st_mtime_ns for path in site_packages_dirs(prefix)]
+    return [reader_name, meta_st.st_mtime_ns, history, site_packages]
+
+def load_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(path, cache, env_prefixes):
+    """Writes the cache atomically, dropping environments that no longer exist"""
+    current = set(env_prefixes)
+    cache = {prefix: entry for prefix, entry in cache.items() if prefix in current}
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp, path)
+
+def env_name(prefix):
+    # Get env name from env prefix
+    if prefix.count('env') == 0:
+        return "base"
+    return os.path.basename(prefix)
+
+def cli_environments():
+    print("Gathering list of environments from conda...")
+    env_json = sp.run(['conda', 'info', '--envs', '--json'], capture_output=True, text=True).stdout
+    return json.loads(env_json)['envs']
+
+def find_environments(conda_root=None, envs_dirs=None):
+    """
+    Lists the environment prefixes the way `conda info --envs` does, but
+    from the filesystem: the root prefix, every environment under the
+    envs directories and every prefix in ~/.conda/environments.txt.
+    Only directories with a conda-meta folder count.
+
+    Parameters
+    ----------
+    conda_root : str, optional
+        Root (base) prefix of the installation. Found from $CONDA_ROOT,
+        $CONDA_EXE or the conda on PATH if not given.
+    envs_dirs : list of str, optional
+        Directories holding named environments. Default: $CONDA_ENVS_PATH,
+        else <root>/envs and ~/.conda/envs
+    """
+    if conda_root is None:
+        conda_root = os.environ.get('CONDA_ROOT')
+    if conda_root is None:
+        conda_exe = os.environ.get('CONDA_EXE') or shutil.which('conda')
+        if conda_exe:
+            # conda lives in <root>/bin or <root>/condabin
+            conda_root = os.path.dirname(os.path.dirname(os.path.realpath(conda_exe)))
+    if not envs_dirs:
+        envs_path = os.environ.get('CONDA_ENVS_PATH') or os.environ.get('CONDA_ENVS_DIRS')
+        if envs_path:
+            envs_dirs = envs_path.split(os.pathsep)
+        else:
+            envs_dirs = ([os.path.join(conda_root, 'envs')] if conda_root else []) + [os.path.expanduser('~/.conda/envs')]
+    candidates = [conda_root] if conda_root else []
+    for envs_dir in envs_dirs:
+        try:
+            candidates.extend(sorted(entry.path for entry in os.scandir(envs_dir) if entry.is_dir()))
+        except OSError:
+            pass
+    try:
+        with open(os.path.expanduser('~/.conda/environments.txt')) as f:
+            candidates.extend(line.strip() for line in f if line.strip())
+    except OSError:
+        pass
+    env_prefixes = []
+    seen = set()
+    for prefix in candidates:
+        real = os.path.realpath(prefix)
+        if real not in seen and os.path.isdir(os.path.join(prefix, 'conda-meta')):
+            seen.add(real)
+            env_prefixes.append(os.path.normpath(prefix))
+    return env_prefixes
+
+def read_conda_meta(prefix):
+    """
+    Reads the package records of one environment straight from its
+    conda-meta/*.json files, plus the pip-installed packages that conda
+    list also reports. Returns the same records and errors as
+    list_packages, without starting conda.
+    """
+    records = []
+    conda_files = set()
+    try:
+        meta_files = sorted(entry.path for entry in os.scandir(os.path.join(prefix, 'conda-meta'))
+                            if entry.name.endswith('.json'))
+    except OSError as e:
+        return [], "{}: {}".format(prefix, e)
+    for path in meta_files:
+        try:
+            with open(path) as f:
+                pkg = json.load(f)
+        except (OSError, ValueError) as e:
+            return [], "{}: could not read {}: {}".format(prefix, os.path.basename(path), e)
+        records.append({
+                'package': pkg['name'],
+                'version': pkg['version'],
+                'env': env_name(prefix),
+                'channel': channel_name(pkg.get('channel') or pkg.get('url', '')),
+                'build': pkg['build']
+                })
+        conda_files.update(pkg.get('files', []))
+    records.extend(read_pip_packages(prefix, conda_files))
+    records.sort(key=lambda record: record['package'])
+    return records, None
+
+def site_packages_dirs(prefix):
+    return sorted(glob.glob(os.path.join(prefix, 'lib', 'python*', 'site-packages'))
+                  + glob.glob(os.path.join(prefix, 'Lib', 'site-packages')))
+
+def read_pip_packages(prefix, conda_files):
+    """
+    Package records for the Python distributions in site-packages that no
+    conda package installed, i.e. those conda list shows with channel
+    pypi. As in conda, a distribution belongs to a conda package if its
+    .dist-info/RECORD or .egg-info/PKG-INFO is among that package's files.
+    """
+    records = []
+    for site_packages in site_packages_dirs(prefix):
+        try:
+            entries = sorted(os.scandir(site_packages), key=lambda entry: entry.name)
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name.endswith('.dist-info'):
+                anchor, metadata = os.path.join(entry.path, 'RECORD'), os.path.join(entry.path, 'METADATA')
+            elif entry.name.endswith('.egg-info'):
+                anchor = metadata = os.path.join(entry.path, 'PKG-INFO') if entry.is_dir() else entry.path
+            else:
+                continue
+            if os.path.relpath(anchor, prefix).replace(os.sep, '/') in conda_files:
+                continue
+            headers = {}
+            try:
+                with open(metadata, encoding='utf-8', errors='replace') as f:
+                    for line in f:
+                        if not line.strip():
+                            break
+                        key, _, value = line.partition(':')
+                        headers.setdefault(key.strip().lower(), value.strip())
+            except OSError:
+                continue
+            if 'name' not in headers or 'version' not in headers:
+                continue
+            records.append({
+                    'package': re.sub(r'[._]', '-', headers['name'].lower()),
+                    'version': headers['version'],
+                    'env': env_name(prefix),
+                    'channel': 'pypi',
+                    'build': 'pypi_0'
+                    })
+    return records
+
+def list_packages(prefix):
+    """
+    Runs conda list for one environment. Returns its package records and
+    the error message conda gave, if any.
+    """
+    pkg_json = sp.run(['conda', 'list', '--json', '-p', prefix], capture_output=True, text=True).stdout
+    try:
+        pkgs_obj = json.loads(pkg_json)
+    except json.JSONDecodeError as e:
+        return [], "{}: could not parse conda list output: {}".format(prefix, e)
+    # Detect conda errors
+    if isinstance(pkgs_obj, dict) and 'error' in pkgs_obj.keys():
+        return [], pkgs_obj['error']
+    # Create package records for output
+    records = []
+    for pkg in pkgs_obj:
+        record = {
+                'package': pkg['name'],
+                'version': pkg['version'],
+                'env': env_name(prefix),
+                'channel': pkg['channel'],
+                'build': pkg['build_string']
+                }
+        records.append(record)
+    return records, None
+
+def package_files(prefix):
+    """
+    Stats every file that the packages of one environment installed, as
+    listed in conda-meta. Returns {package: [(dev, inode), ...]} and
+    {(dev, inode): (bytes on disk, link count)}.
+    """
+    files = {}
+    inodes = {}
+    try:
+        meta_files = [entry.path for entry in os.scandir(os.path.join(prefix, 'conda-meta')) if entry.name.endswith('.json')]
+    except OSError:
+        return files, inodes
+    for path in meta_files:
+        try:
+            with open(path) as f:
+                pkg = json.load(f)
+        except (OSError, ValueError):
+            continue
+        keys = files.setdefault(pkg['name'], [])
+        for name in pkg.get('files', []):
+            try:
+                st = os.lstat(os.path.join(prefix, name))
+            except OSError:
+                continue
+            key = (st.st_dev, st.st_ino)
+            keys.append(key)
+            inodes[key] = (st.st_blocks * 512, st.st_nlink)
+    return files, inodes
+
+def disk_usage(env_prefixes, jobs):
+    """
+    Disk usage of each environment and of each package in it. A file's
+    bytes are unique to an environment (or package) if every hard link
+    to it is inside it, so deleting it would free them, and shared
+    otherwise, e.g. when conda hardlinked it from the package cache.
+    Each inode is counted once per environment or package.
+
+    Returns
+    -------
+    tuple
+        {(env, package): (unique, shared)} and {env: (unique, shared)}
+    """
+    def usage(keys, inodes):
+        counts = {}
+        for key in keys:
+            counts[key] = counts.get(key, 0) + 1
+        unique = shared = 0
+        for key, count in counts.items():
+            size, nlink = inodes[key]
+            if count >= nlink:
+                unique += size
+            else:
+                shared += size
+        return unique, shared
+    package_usage = {}
+    env_usage = {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for prefix, (files, inodes) in zip(env_prefixes, pool.map(package_files, env_prefixes)):
+            env = env_name(prefix)
+            for package, keys in files.items():
+                package_usage[env, package] = usage(keys, inodes)
+            env_usage[env] = usage([key for keys in files.values() for key in keys], inodes)
+    return package_usage, env_usage
+
+def channel_name(channel):
+    """
+    Shortens a channel URL from a conda-meta record to the name conda list
+    shows, e.g. https://repo.anaconda.com/pkgs/main/linux-64 to pkgs/main
+    and https://conda.anaconda.org/conda-forge/noarch to conda-forge
+    """
+    channel = channel.rstrip('/')
+    if channel.endswith('.conda') or channel.endswith('.tar.bz2'):
+        # A package URL rather than a channel
+        channel = channel.rsplit('/', 1)[0]
+    base, _, subdir = channel.rpartition('/')
+    if base and (subdir == 'noarch' or '-' in subdir):
+        channel = base
+    for default_url in ('https://repo.anaconda.com/', 'https://repo.continuum.io/', 'https://conda.anaconda.org/'):
+        if channel.startswith(default_url):
+            return channel[len(default_url):]
+    return channel
+
+def compare_records(meta_records, cli_records):
+    """Lists the packages that the conda-meta reader and conda CLI disagree on"""
+    meta = {tuple(record.values()) for record in meta_records}
+    cli = {tuple(record.values()) for record in cli_records}
+    messages = ["Only in conda-meta: {}".format(" ".join(record)) for record in sorted(meta - cli)]
+    messages += ["Only in conda CLI: {}".format(" ".join(record)) for record in sorted(cli - meta)]
+    if not messages:
+        print("conda-meta and conda CLI agree on all {} packages.".format(len(meta)))
+    return messages
+
+# Each package record is stored once, with the range of snapshots it was
+# present in; last_seen is NULL while it is still installed. A snapshot
+# therefore only writes the records that changed since the previous one.
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    taken TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS records (
+    package TEXT NOT NULL,
+    version TEXT NOT NULL,
+    env TEXT NOT NULL,
+    channel TEXT,
+    build TEXT,
+    first_seen INTEGER NOT NULL REFERENCES snapshots(id),
+    last_seen INTEGER REFERENCES snapshots(id)
+);
+CREATE INDEX IF NOT EXISTS records_package ON records (package, version);
+CREATE INDEX IF NOT EXISTS records_env ON records (env, package);
+CREATE INDEX IF NOT EXISTS records_first_seen ON records (first_seen);
+CREATE INDEX IF NOT EXISTS records_last_seen ON records (last_seen);
+"""
+
+RECORD_COLUMNS = ['package', 'version', 'env', 'channel', 'build']
+
+def open_store(path):
+    db = sqlite3.connect(path)
+    db.executescript(STORE_SCHEMA)
+    return db
+
+def record_snapshot(db, records):
+    """
+    Adds a snapshot of the given package records to the store. Returns
+    the snapshot id and the number of records added and removed since
+    the previous snapshot.
+    """
+    previous = db.execute("SELECT max(id) FROM snapshots").fetchone()[0]
+    snapshot = db.execute("INSERT INTO snapshots (taken) VALUES (?)",
+                          (datetime.now(timezone.utc).isoformat(timespec='seconds'),)).lastrowid
+    current = {row[1:]: row[0] for row in db.execute(
+        "SELECT rowid, {} FROM records WHERE last_seen IS NULL".format(", ".join(RECORD_COLUMNS)))}
+    new = {tuple(record[column] for column in RECORD_COLUMNS) for record in records}
+    removed = [(previous, current[key]) for key in current.keys() - new]
+    db.executemany("UPDATE records SET last_seen = ? WHERE rowid = ?", removed)
+    added = [key + (snapshot,) for key in new - current.keys()]
+    db.executemany("INSERT INTO records ({}, first_seen) VALUES (?, ?, ?, ?, ?, ?)".format(", ".join(RECORD_COLUMNS)), added)
+    return snapshot, len(added), len(removed)
+
+def resolve_snapshot(db, name):
+    """
+    Snapshot id for a command-line argument: an id, a date or time (the
+    last snapshot taken then or earlier), or None for the latest
+    """
+    if name is None:
+        row = db.execute("SELECT max(id) FROM snapshots").fetchone()
+    elif name.isdigit():
+        row = db.execute("SELECT id FROM snapshots WHERE id = ?", (int(name),)).fetchone()
+    else:
+        row = db.execute("SELECT max(id) FROM snapshots WHERE substr(taken, 1, length(?)) <= ?", (name, name)).fetchone()
+    if row is None or row[0] is None:
+        sys.exit("No snapshot matches {}.".format(name or "in the store"))
+    return row[0]
+
+def version_parts(version):
+    """
+    Splits a conda version string into its version and local (after +)
+    components, each a list of tagged parts, following conda's
+    VersionOrder rules: strings sort before numbers, with dev first, then
+    a trailing _, then letters, and post sorts after every number
+    """
+    version = version.strip().lower().replace('-', '_')
+    epoch, _, version = version.rpartition('!')
+    version, _, local = version.partition('+')
+    if version.endswith('_'):
+        # openssl-style versions like 1.0.2_ keep the underscore in their last component
+        components = version[:-1].replace('_', '.').split('.')
+        components[-1] += '_'
+    else:
+        components = version.replace('_', '.').split('.')
+    parsed = []
+    for strings in ([epoch or '0'] + components, local.replace('_', '.').split('.') if local else []):
+        parsed.append([])
+        for component in strings:
+            parts = [(1, int(item)) if item.isdigit() else (1, math.inf) if item == 'post'
+                     else (0, 'DEV' if item == 'dev' else item)
+                     for item in re.findall(r'[0-9]+|[*]+|[^0-9*]+', component)]
+            # A component that starts with a string, like the a1 in 1.1.a1, counts as 0a1
+            if not component[:1].isdigit():
+                parts.insert(0, (1, 0))
+            parsed[-1].append(parts)
+    return parsed
+
+def compare_versions(a, b):
+    """Returns -1, 0 or 1 as conda version a is older than, equal to or newer than b"""
+    if VersionOrder is not None:
+        try:
+            a_order, b_order = VersionOrder(a), VersionOrder(b)
+            return (a_order > b_order) - (a_order < b_order)
+        except Exception:
+            pass
+    # The local versions only decide between equal versions. Missing
+    # components and parts count as 0, so 1.20 == 1.20.0
+    for a_components, b_components in zip(version_parts(a), version_parts(b)):
+        for x, y in itertools.zip_longest(a_components, b_components, fillvalue=[]):
+            for p, q in itertools.zip_longest(x, y, fillvalue=(1, 0)):
+                if p != q:
+                    return -1 if p < q else 1
+    return 0
+
+def version_matches(version, spec):
+    """Checks version against a spec like <1.20, >=2 or ==1.19.5"""
+    match = re.match(r'(<=|>=|==|!=|<|>|=)?\s*(.+)', spec)
+    op, target = match.group(1) or '==', match.group(2)
+    c = compare_versions(version, target)
+    return {'<': c < 0, '<=': c <= 0, '>': c > 0, '>=': c >= 0,
+            '==': c == 0, '=': c == 0, '!=': c != 0}[op]
+
+def query_store(db, args):
+    """Prints the records of a snapshot matching a package, version spec and env"""
+    snapshot = resolve_snapshot(db, args.at)
+    where = ["first_seen <= ?", "(last_seen IS NULL OR last_seen >= ?)"]
+    params = [snapshot, snapshot]
+    if args.package:
+        where.append("package = ?")
+        params.append(args.package)
+    if args.env:
+        where.append("env = ?")
+        params.append(args.env)
+    rows = db.execute("SELECT {} FROM records WHERE {} ORDER BY package, env".format(
+        ", ".join(RECORD_COLUMNS), " AND ".join(where)), params)
+    print("\t".join(RECORD_COLUMNS))
+    for row in rows:
+        if args.version is None or version_matches(row[1], args.version):
+            print("\t".join(value or '' for value in row))
+
+def diff_snapshots(db, args):
+    """
+    Prints the packages installed, removed or changed in each env between
+    two snapshots, by default the previous and latest ones
+    """
+    new = resolve_snapshot(db, args.new)
+    old = resolve_snapshot(db, args.old) if args.old is not None else new - 1
+    def present(key, snapshot):
+        return db.execute("SELECT {} FROM records WHERE env = ? AND package = ? AND first_seen <= ? "
+                          "AND (last_seen IS NULL OR last_seen >= ?)".format(", ".join(RECORD_COLUMNS)),
+                          key + (snapshot, snapshot)).fetchone()
+    # Only records that started or ended between the two snapshots can differ
+    changed = db.execute("SELECT DISTINCT env, package FROM records WHERE first_seen BETWEEN ? AND ? OR last_seen BETWEEN ? AND ?",
+                         (old + 1, new, old, new - 1)).fetchall()
+    if not changed:
+        print("No differences between snapshots {} and {}.".format(old, new))
+        return
+    print("change\tenv\tpackage\told\tnew")
+    for key in sorted(changed):
+        a, b = present(key, old), present(key, new)
+        if a == b:
+            continue
+        change = 'added' if a is None else 'removed' if b is None else 'changed'
+        describe = lambda row: "" if row is None else "{} {} {}".format(row[1], row[4], row[3])
+        print("\t".join([change, key[0], key[1], describe(a), describe(b)]))
+
+def list_snapshots(db, args):
+    rows = db.execute("SELECT id, taken FROM snapshots ORDER BY id")
+    print("snapshot\ttaken")
+    for row in rows:
+        print("\t".join(str(value) for value in row))
 
 def main_original(args):
     results_json = sp.run(['conda', 'search', '--envs', '--json'], capture_output=True, text=True).stdout
@@ -85,5 +612,29 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=desc)
     parser.add_argument('-o', '--output', default='output.tsv', help="Output file destination. Default: %(default)s")
     parser.add_argument('--excel', help="Additional optional file output in XLSX format.")
+    parser.add_argument('--cli', action='store_true', help="Ask the conda CLI for the environments and packages instead of reading conda-meta directly. Slower, but follows conda's own configuration.")
+    parser.add_argument('--check', action='store_true', help="Also run the conda CLI and report any package on which it and the conda-meta reader disagree.")
+    parser.add_argument('--conda-root', help="Root prefix of the conda installation. Default: $CONDA_ROOT, else found from $CONDA_EXE or the conda on PATH")
+    parser.add_argument('--envs-dir', action='append', help="Directory of named environments. May be repeated. Default: $CONDA_ENVS_PATH, else <root>/envs and ~/.conda/envs")
+    parser.add_argument('--cache', default=os.environ.get('CONDA_INVENTORY_CACHE', os.path.expanduser('~/.cache/conda-inventory.json')),
+                        help="File holding each environment's package records between runs, so only environments that changed are read again. Default: $CONDA_INVENTORY_CACHE, else %(default)s")
+    parser.add_argument('--no-cache', action='store_true', help="Don't read or write the inventory cache.")
+    parser.add_argument('--refresh', action='store_true', help="Read every environment again and rebuild its cache entry.")
+    parser.add_argument('-j', '--jobs', type=int, default=4, help="Number of environments to enumerate at once. Default: %(default)s")
+    parser.add_argument('--disk-usage', action='store_true', help="Add columns with the bytes each package and environment uses on disk, split into bytes only it uses (freed if it is removed) and bytes hardlinked from elsewhere.")
+    parser.add_argument('--store', default=os.environ.get('CONDA_INVENTORY_DB'),
+                        help="SQLite inventory store. Each run adds a snapshot to it, and the commands below query it. Default: $CONDA_INVENTORY_DB, else none")
+    subparsers = parser.add_subparsers(dest='command', title="commands", description="Query the --store instead of taking an inventory.")
+    query = subparsers.add_parser('query', help="List the package records in a snapshot.")
+    query.add_argument('package', nargs='?', help="Package name. Default: all packages")
+    query.add_argument('version', nargs='?', help="Version spec such as '<1.20', '>=2' or '==1.19.5'")
+    query.add_argument('--env', help="Only this environment.")
+    query.add_argument('--at', help="Snapshot id, or a date or time to use the last snapshot taken then. Default: latest")
+    diff = subparsers.add_parser('diff', help="List packages added, removed or changed between two snapshots.")
+    diff.add_argument('old', nargs='?', help="Snapshot id, date or time. Default: the one before NEW")
+    diff.add_argument('new', nargs='?', help="Snapshot id, date or time. Default: latest")
+    subparsers.add_parser('snapshots', help="List the snapshots in the store.")
     args = parser.parse_args()
+    if args.no_cache:
+        args.cache = None
     main(args)
@@ -1,8 +1,21 @@
 #!/home/pwoods/miniconda3/bin/python
+import os
 import sys
-import os.path
+import stat
+import time
+import glob
+import select
+import json
 import argparse
 import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+NEWLINE = ord('\n')
+QUANTILES = [10, 25, 50, 75, 90]
+# Fields are gathered into a lines x width array, so one long field must
+# not set the width for a whole chunk. Wider fields are handled one by one.
+MAX_FIELD_WIDTH = 32
 
 class Histogram(object):
     """
@@ -10,16 +23,33 @@ class Histogram(object):
     Taken from https://pyinsci.blogspot.com/2009/10/ascii-histograms.html
     Licenced under GPL
     """
-    def __init__(self, data, bins=10):
+    def __init__(self, data, bins=10, range=None, weights=None):
         """
         Class constructor
 
         :Parameters:
             - `data`: array like object
+            - `range`: (min, max) of the data, if already known
+            - `weights`: optional weight for each value
         """
         self.data = data
         self.bins = bins
-        self.h = np.histogram(self.data, bins=self.bins)
+        self.h = np.histogram(self.data, bins=self.bins, range=range, weights=weights)
+
+    @classmethod
+    def from_counts(cls, counts, edges):
+        """
+        Build a histogram from precomputed bin counts instead of raw data
+
+        :Parameters:
+            - `counts`: count (or total weight) for each bin
+            - `edges`: bin edges, one longer than `counts`
+        """
+        h = cls.__new__(cls)
+        h.data = None
+        h.bins = len(counts)
+        h.h = (np.asarray(counts), np.asarray(edges, dtype=np.float64))
+        return h
 
     def horizontal(self, height=4, character ='|'):
         """Returns a multiline string containing a
@@ -37,23 +67,17 @@ class Histogram(object):
                    |||||||||||||
         -3.42                         3.09
         """
-        his = """"""
-        bars = self.h[0]*height/max(self.h[0])
+        his = []
+        bars = self.h[0]*height/max(max(self.h[0]), 1)
         for l in reversed(range(1,height+1)):
-            line = ""
             if l == height:
                 line = '%s '%max(self.h[0]) #histogram top count
             else:
                 line = ' '*(len(str(max(self.h[0])))+1) #add leading spaces
-            for c in bars:
-                if c >= np.ceil(l):
-                    line += character
-                else:
-                    line += ' '
-            line +='\n'
-            his += line
-        his += '%.2f'%self.h[1][0] + ' '*(self.bins) +'%.2f'%self.h[1][-1] + '\n'
-        return his
+            line += ''.join(character if c >= np.ceil(l) else ' ' for c in bars)
+            his.append(line+'\n')
+        his.append('%.2f'%self.h[1][0] + ' '*(self.bins) +'%.2f'%self.h[1][-1] + '\n')
+        return ''.join(his)
 
     def vertical(self,height=20, character ='|'):
         """
@@ -77,56 +101,817 @@ class Histogram(object):
         1.68 : *
         2.32 :
         """
-        his = """"""
         xl = ['%.2f'%n for n in self.h[1]]
         lxl = [len(l) for l in xl]
-        bars = self.h[0]*height//max(self.h[0])
-        his += ' '*(max(bars)+2+max(lxl))+'%s\n'%max(self.h[0])
+        bars = (self.h[0]*height//max(max(self.h[0]), 1)).astype(int)
+        his = [' '*(max(bars)+2+max(lxl))+'%s\n'%max(self.h[0])]
         for i,c in enumerate(bars):
-            line = xl[i] +' '*(max(lxl)-lxl[i])+': '+ character*c+'\n'
-            his += line
-        return his
+            his.append(xl[i] +' '*(max(lxl)-lxl[i])+': '+ character*c+'\n')
+        return ''.join(his)
 
-def main(args):
-    data = []
-    if args.file:
-        with open(args.file, 'r') as f:
-            remaining_header = args.header
+class RunningStats(object):
+    """
+    Exact count, min, max, mean and variance accumulated one batch at a
+    time (Welford, with Chan et al.'s update for combining batches).
+    Two instances can be merged, so partial results can be combined.
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if values.size == 0:
+            return
+        other = RunningStats()
+        other.n = values.size
+        other.mean = float(np.mean(values))
+        other.m2 = float(np.sum((values - other.mean)**2))
+        other.min = float(np.min(values))
+        other.max = float(np.max(values))
+        self.merge(other)
+
+    def merge(self, other):
+        if other.n == 0:
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta**2 * self.n * other.n / n
+        self.n = n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def std(self):
+        # Population standard deviation, to match np.std
+        return np.sqrt(self.m2 / self.n) if self.n else np.nan
+
+class KLLSketch(object):
+    """
+    KLL quantile sketch (Karnin, Lang & Liberty, 2016)
+    Keeps O(k log(n/k)) values no matter how many are added. With the
+    default k=200 the rank of a reported quantile is within about 1.7%
+    of n of the true rank (99% confidence). Sketches can be merged.
+    """
+    def __init__(self, k=200, c=2/3):
+        self.k = k
+        self.c = c
+        self.n = 0
+        self.levels = [np.empty(0)]
+        self.rng = np.random.default_rng()
+
+    def _capacity(self, h):
+        depth = len(self.levels) - h - 1
+        return max(2, int(np.ceil(self.k * self.c**depth)))
+
+    def _compress(self):
+        while sum(len(l) for l in self.levels) >= sum(self._capacity(h) for h in range(len(self.levels))):
+            for h, level in enumerate(self.levels):
+                if len(level) < self._capacity(h):
+                    continue
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                # Keep a random half of the sorted items at double the weight.
+                # With an odd count the largest item stays on this level.
+                level = np.sort(level)
+                odd = len(level) % 2
+                paired = level[:len(level) - odd]
+                self.levels[h+1] = np.concatenate([self.levels[h+1], paired[self.rng.integers(2)::2]])
+                self.levels[h] = level[len(level) - odd:]
+                break
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        self.n += values.size
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for h, level in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], level])
+        self.n += other.n
+        self._compress()
+
+    def weighted_items(self):
+        """Returns the retained items and their weights; the weights sum to n"""
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(l), 2**h, dtype=np.int64) for h, l in enumerate(self.levels)])
+        return items, weights
+
+    def quantile(self, q):
+        """Approximate value at fraction `q` of the data, 0 <= q <= 1"""
+        items, weights = self.weighted_items()
+        order = np.argsort(items)
+        items, cumulative = items[order], np.cumsum(weights[order])
+        idx = np.searchsorted(cumulative, q * cumulative[-1], side='left')
+        return items[min(idx, len(items) - 1)]
+
+class StreamSummary(object):
+    """
+    Fixed-memory summary of a stream of values: exact moments, bin counts
+    and a quantile sketch. If `value_range` is given the bin counts are
+    exact over that range; otherwise they are estimated from the sketch
+    over the exact min and max.
+    """
+    def __init__(self, bins=30, value_range=None):
+        self.stats = RunningStats()
+        self.sketch = KLLSketch()
+        self.bins = bins
+        self.edges = None
+        self.counts = None
+        self.out_of_range = 0
+        if value_range is not None:
+            self.edges = np.linspace(value_range[0], value_range[1], bins + 1)
+            self.counts = np.zeros(bins, dtype=np.int64)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        self.stats.update(values)
+        self.sketch.update(values)
+        if self.counts is not None:
+            counts = np.histogram(values, bins=self.edges)[0]
+            self.counts += counts
+            self.out_of_range += values.size - int(counts.sum())
+
+    def merge(self, other):
+        self.stats.merge(other.stats)
+        self.sketch.merge(other.sketch)
+        if self.counts is not None:
+            self.counts += other.counts
+            self.out_of_range += other.out_of_range
+
+    def histogram(self):
+        if self.counts is not None:
+            return Histogram.from_counts(self.counts, self.edges)
+        items, weights = self.sketch.weighted_items()
+        counts, edges = np.histogram(items, bins=self.bins, range=(self.stats.min, self.stats.max), weights=weights)
+        return Histogram.from_counts(counts, edges)
+
+    def percentile(self, p):
+        if p <= 0:
+            return self.stats.min
+        if p >= 100:
+            return self.stats.max
+        return float(self.sketch.quantile(p / 100))
+
+    def result(self, quantiles=QUANTILES):
+        """Returns the same structure as compute_stats"""
+        s = self.stats
+        return {'count': s.n, 'min': s.min, 'max': s.max, 'mean': s.mean, 'stdev': float(s.std),
+                'quantiles': {p: self.percentile(p) for p in quantiles}}
+
+class RollingWindow(object):
+    """
+    Bin counts over the most recent values only: either the last
+    `max_count` values or those that arrived in the last `max_age`
+    seconds. Counts are added and subtracted as batches enter and leave
+    the window, so memory and update cost depend on the window size.
+    With neither limit set, the window is everything seen so far and no
+    values are kept; the stats then come from a StreamSummary.
+    """
+    def __init__(self, edges, max_count=None, max_age=None):
+        self.edges = edges
+        self.bins = len(edges) - 1
+        self.max_count = max_count
+        self.max_age = max_age
+        self.counts = np.zeros(self.bins, dtype=np.int64)
+        self.out_of_range = 0
+        self.n = 0
+        # Each entry is [arrival time, values, bin index of each value]
+        self.batches = deque()
+        self.summary = StreamSummary(bins=self.bins) if max_count is None and max_age is None else None
+
+    def _bin(self, values):
+        # Same bins as np.histogram: the last bin includes its right edge
+        idx = np.minimum(np.searchsorted(self.edges, values, side='right') - 1, self.bins - 1)
+        idx[(values < self.edges[0]) | (values > self.edges[-1])] = -1
+        return idx
+
+    def _add(self, idx, sign):
+        self.counts += sign * np.bincount(idx[idx >= 0], minlength=self.bins)
+        self.out_of_range += sign * int(np.count_nonzero(idx < 0))
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if values.size == 0:
+            return
+        idx = self._bin(values)
+        self._add(idx, 1)
+        self.n += values.size
+        if self.summary is not None:
+            self.summary.update(values)
+            return
+        self.batches.append([time.monotonic(), values, idx])
+        self.evict()
+
+    def evict(self):
+        now = time.monotonic()
+        while self.batches:
+            arrived, values, idx = self.batches[0]
+            if self.max_age is not None and arrived < now - self.max_age:
+                drop = len(values)
+            elif self.max_count is not None and self.n > self.max_count:
+                drop = min(len(values), self.n - self.max_count)
+            else:
+                break
+            self._add(idx[:drop], -1)
+            self.n -= drop
+            if drop == len(values):
+                self.batches.popleft()
+            else:
+                self.batches[0] = [arrived, values[drop:], idx[drop:]]
+
+    def histogram(self):
+        return Histogram.from_counts(self.counts, self.edges)
+
+    def stats(self, quantiles=QUANTILES):
+        """compute_stats for the values in the window, or None if it is empty"""
+        if self.n == 0:
+            return None
+        if self.summary is not None:
+            return self.summary.result(quantiles)
+        return compute_stats(np.concatenate([b[1] for b in self.batches]), quantiles=quantiles)
+
+def parse_lines(buf, columns, sep, key_column=None):
+    """
+    Extracts numeric columns from a block of complete lines without a
+    Python-level loop over the lines. Fields are split exactly as
+    str.split(sep) would split them.
+
+    :Parameters:
+        - `buf`: uint8 array of whole lines, each ending in a newline
+        - `columns`: list of 1-based column numbers
+        - `sep`: the separator as a single byte value
+        - `key_column`: optional 1-based column to return as raw bytes
+    Returns a float64 array with one row per parsed line and one column
+    per requested column, the key field of each parsed line as a bytes
+    array (None without `key_column`), and the 0-based indices of the
+    lines that could not be parsed (too few fields or not a number).
+    """
+    ends = np.flatnonzero(buf == NEWLINE)
+    starts = np.empty_like(ends)
+    starts[0:1] = 0
+    starts[1:] = ends[:-1] + 1
+    # A sentinel past the end of the block keeps every lookup in bounds
+    seps = np.append(np.flatnonzero(buf == sep), len(buf))
+    first = np.searchsorted(seps, starts)
+    valid = np.ones(len(ends), dtype=bool)
+    values = np.empty((len(ends), len(columns)), dtype=np.float64)
+    for j, column in enumerate(columns):
+        values[:, j] = _parse_field(buf, seps, first, starts, ends, column, valid)
+    keys = None
+    if key_column is not None:
+        keys, wide = _field_bytes(buf, seps, first, starts, ends, key_column, valid)
+        if wide:
+            keys = keys.astype(object)
+            for i, field in wide.items():
+                keys[i] = field
+        keys = keys[valid]
+    return values[valid], keys, np.flatnonzero(~valid)
+
+def _field_bytes(buf, seps, first, starts, ends, column, valid):
+    """
+    Gathers one column of every line into a NUL-padded fixed-width bytes
+    array, clearing `valid` for lines that have too few fields. Fields
+    longer than MAX_FIELD_WIDTH are left empty in that array and returned
+    separately, as a dict of line index to bytes.
+    """
+    if column == 1:
+        field_starts = starts
+    else:
+        k = np.minimum(first + column - 2, len(seps) - 1)
+        valid &= seps[k] < ends
+        field_starts = seps[k] + 1
+    k = np.minimum(first + column - 1, len(seps) - 1)
+    field_ends = np.where(seps[k] < ends, seps[k], ends)
+    widths = np.where(valid, field_ends - field_starts, 0)
+    wide = widths > MAX_FIELD_WIDTH
+    widths[wide] = 0
+    width = max(int(widths.max(initial=0)), 1)
+    padded = np.concatenate([buf, np.zeros(width, dtype=np.uint8)])
+    windows = np.lib.stride_tricks.sliding_window_view(padded, width)
+    cells = windows[np.minimum(field_starts, len(buf))]
+    cells[np.arange(width) >= widths[:, None]] = 0
+    fields = cells.view('S{}'.format(width)).ravel()
+    return fields, {i: buf[field_starts[i]:field_ends[i]].tobytes() for i in np.flatnonzero(wide)}
+
+def _parse_field(buf, seps, first, starts, ends, column, valid):
+    """Converts one column of every line, clearing `valid` where that fails"""
+    # Fixed-width byte strings let NumPy convert the whole block in one call
+    fields, wide = _field_bytes(buf, seps, first, starts, ends, column, valid)
+    wide_lines = list(wide)
+    present = fields != b''
+    present[wide_lines] = True
+    valid &= present
+    narrow = valid.copy()
+    narrow[wide_lines] = False
+    values = np.empty(len(ends), dtype=np.float64)
+    try:
+        values[narrow] = fields[narrow].astype(np.float64)
+    except ValueError:
+        # Only blocks that contain bad lines pay for the per-field fallback
+        for i in np.flatnonzero(narrow):
+            try:
+                values[i] = float(fields[i])
+            except ValueError:
+                valid[i] = False
+    for i, field in wide.items():
+        try:
+            values[i] = float(field)
+        except ValueError:
+            valid[i] = False
+    return values
+
+class ColumnReader(object):
+    """
+    Reads numeric columns of a delimited file in fixed-size chunks.
+    Iterating yields float64 arrays of shape (lines, len(columns)), one
+    per chunk. Malformed lines are counted and skipped rather than
+    stopping the run; call report() to print a summary of them.
+
+    If `key_column` is given, its text is mapped to an integer group code
+    that is appended as an extra last column; group_names[code] gives the
+    original text back.
+    """
+    def __init__(self, path, columns=[1], sep='\t', header=0, chunk_size=1<<24, key_column=None):
+        self.path = path
+        self.columns = list(columns)
+        self.key_column = key_column
+        self.width = len(self.columns) + (key_column is not None)
+        self.group_names = []
+        self._group_codes = {}
+        self.sep = sep
+        self.header = header
+        self.chunk_size = chunk_size
+        self.lines = 0
+        self.malformed = 0
+        self.examples = []
+        self._header_left = header
+        self._leftover = b''
+
+    def __iter__(self):
+        if len(self.sep.encode()) != 1:
+            # Multi-character separators can't be found with a byte comparison
+            yield from self.iter_lines()
+            return
+        source = sys.stdin.buffer if self.path == '-' else open(self.path, 'rb')
+        with source:
+            for chunk in iter(lambda: source.read(self.chunk_size), b''):
+                yield self.feed(chunk)
+        yield self.flush()
+
+    def feed(self, data):
+        """
+        Parses the complete lines in `data` and returns their values. A
+        trailing partial line is kept back until the next call.
+        """
+        block = self._leftover + data
+        cut = block.rfind(b'\n') + 1
+        block, self._leftover = block[:cut], block[cut:]
+        while self._header_left > 0 and block:
+            block = block[block.find(b'\n') + 1:]
+            self._header_left -= 1
+            self.lines += 1
+        return self._parse(block)
+
+    def flush(self):
+        """Parses a final line that has no trailing newline"""
+        block, self._leftover = self._leftover, b''
+        if self._header_left > 0:
+            return np.empty((0, self.width))
+        return self._parse(block + b'\n' if block else block)
+
+    def iter_lines(self, batch_size=65536):
+        """The line-by-line parser, used for multi-character separators"""
+        batch = []
+        with (sys.stdin if self.path == '-' else open(self.path, 'r')) as f:
             for line in f:
-                if remaining_header > 0:
-                    remaining_header = remaining_header - 1
+                self.lines += 1
+                if self.lines <= self.header:
                     continue
-                fields = line.split(sep=args.sep)
-                data.append(float(fields[args.column-1]))
+                fields = line.split(sep=self.sep)
+                try:
+                    row = [float(fields[c-1]) for c in self.columns]
+                    if self.key_column is not None:
+                        row.append(self._group_code(fields[self.key_column-1]))
+                    batch.append(row)
+                except (ValueError, IndexError):
+                    self._record_malformed([self.lines])
+                if len(batch) == batch_size:
+                    yield np.array(batch)
+                    batch = []
+        if batch:
+            yield np.array(batch)
+
+    def _parse(self, block):
+        if not block:
+            return np.empty((0, self.width))
+        values, keys, bad = parse_lines(np.frombuffer(block, dtype=np.uint8), self.columns,
+                                        self.sep.encode()[0], self.key_column)
+        self._record_malformed(self.lines + 1 + bad)
+        self.lines += block.count(b'\n')
+        if keys is not None:
+            # Only the distinct keys of the block go through the dictionary
+            uniques, inverse = np.unique(keys, return_inverse=True)
+            codes = np.array([self._group_code(k.decode()) for k in uniques], dtype=np.float64)
+            values = np.column_stack([values, codes[inverse.ravel()]])
+        return values
+
+    def _group_code(self, key):
+        key = key.strip()
+        if key not in self._group_codes:
+            self._group_codes[key] = len(self.group_names)
+            self.group_names.append(key)
+        return self._group_codes[key]
+
+    def _record_malformed(self, line_numbers):
+        self.malformed += len(line_numbers)
+        self.examples.extend(int(n) for n in line_numbers[:10 - len(self.examples)])
+
+    def report(self):
+        if self.malformed:
+            print("Skipped {} malformed line(s) in {}. First: {}".format(
+                  self.malformed, self.path, ", ".join(str(n) for n in self.examples)), file=sys.stderr)
+
+def expand_files(pattern):
+    """
+    Returns the files matching a glob pattern, or ['-'] for stdin. A path
+    to an existing file is returned as is, even if it looks like a glob.
+    """
+    if pattern == '-' or os.path.isfile(pattern):
+        return [pattern]
+    return sorted(f for f in glob.glob(pattern) if os.path.isfile(f))
+
+def read_columns(args):
+    """
+    Returns the selected columns of a single input as a float array with
+    one column per entry in args.column, followed by the weights column
+    if there is one and then the group codes if args.group_column is set.
+    Also returns the group names, indexed by code.
+    """
+    if not args.file:
+        return np.array([float(x) for x in args.data]).reshape(-1, 1), []
+    columns = args.column + ([args.weight_column] if args.weight_column else [])
+    reader = ColumnReader(args.file, columns=columns, sep=args.sep, header=args.header, key_column=args.group_column)
+    data = np.concatenate(list(reader) or [np.empty((0, reader.width))])
+    reader.report()
+    return data, reader.group_names
+
+def summarize_file(path, columns, sep, header, value_range):
+    """
+    Reads one file and returns a StreamSummary for each column together
+    with the reader, whose malformed line counts the caller can report.
+    Runs in a worker process when several files are summarized.
+    """
+    summaries = [StreamSummary(bins=30, value_range=value_range) for c in columns]
+    reader = ColumnReader(path, columns=columns, sep=sep, header=header)
+    for block in reader:
+        for j, summary in enumerate(summaries):
+            summary.update(block[:, j])
+    return summaries, reader
+
+def summarize_files(files, args):
+    """
+    Summarizes every file once, in parallel, and merges the per-file
+    bin counts, moments and sketches into one summary per column.
+    """
+    merged = [StreamSummary(bins=30, value_range=args.range) for c in args.column]
+    n = len(files)
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        results = pool.map(summarize_file, files, [args.column]*n, [args.sep]*n, [args.header]*n, [args.range]*n)
+        for summaries, reader in results:
+            reader.report()
+            for total, summary in zip(merged, summaries):
+                total.merge(summary)
+    return merged
+
+def benchmark(args):
+    """Times the chunked parser against the line-by-line loop on args.file"""
+    timings = {}
+    results = {}
+    for name in ['line loop', 'chunked']:
+        reader = ColumnReader(args.file, columns=args.column, sep=args.sep, header=args.header)
+        start = time.perf_counter()
+        batches = reader.iter_lines() if name == 'line loop' else reader
+        results[name] = np.concatenate(list(batches) or [np.empty((0, len(args.column)))])
+        timings[name] = time.perf_counter() - start
+        print("{:10s} {:8.3f} s  {} values".format(name, timings[name], len(results[name])))
+    print("Speedup:   {:8.1f}x".format(timings['line loop'] / timings['chunked']))
+    if not np.array_equal(results['line loop'], results['chunked']):
+        sys.exit("The two parsers returned different values.")
+
+def compute_stats(values, weights=None, quantiles=QUANTILES):
+    """
+    Summary statistics of `values`. Every requested quantile, and the
+    min and max, comes from a single np.partition call (or one sort when
+    weighted) rather than a separate pass for each.
+
+    Parameters
+    ----------
+    values : array like
+        The data
+    weights : array like, optional
+        Non-negative weight for each value
+    quantiles : list of float
+        Percentiles to report, between 0 and 100
+
+    Returns
+    -------
+    dict
+        count, min, max, mean, stdev and 'quantiles', which maps each
+        requested percentile to its value. Weighted results also have
+        'weight', the total weight. Unweighted quantiles interpolate like
+        np.percentile; weighted quantiles are the smallest value whose
+        cumulative weight reaches that fraction of the total.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = values.size
+    percents = np.asarray(quantiles, dtype=np.float64)
+    if weights is None:
+        positions = percents / 100 * (n - 1)
+        lo = np.floor(positions).astype(np.int64)
+        hi = np.ceil(positions).astype(np.int64)
+        part = np.partition(values, np.unique(np.concatenate([[0, n - 1], lo, hi])))
+        q = part[lo] + (part[hi] - part[lo]) * (positions - lo)
+        mean = values.mean()
+        stdev = values.std()
+        minimum, maximum = part[0], part[n - 1]
+    else:
+        weights = np.asarray(weights, dtype=np.float64)
+        order = np.argsort(values)
+        ordered = values[order]
+        cumulative = np.cumsum(weights[order])
+        idx = np.searchsorted(cumulative, percents / 100 * cumulative[-1], side='left')
+        q = ordered[np.minimum(idx, n - 1)]
+        mean = np.average(values, weights=weights)
+        stdev = np.sqrt(np.average((values - mean)**2, weights=weights))
+        minimum, maximum = ordered[0], ordered[-1]
+    stats = {'count': n, 'min': float(minimum), 'max': float(maximum), 'mean': float(mean),
+             'stdev': float(stdev), 'quantiles': {p: float(v) for p, v in zip(quantiles, q)}}
+    if weights is not None:
+        stats['weight'] = float(cumulative[-1])
+    return stats
+
+def group_stats(values, codes, n_groups, bins=30, quantiles=QUANTILES):
+    """
+    Histograms and statistics for every group in one vectorized pass.
+    All groups share the same bins, spanning the range of all values.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        The data
+    codes : numpy.ndarray
+        Integer group code of each value, from 0 to n_groups - 1
+    n_groups : int
+        Number of groups
+    bins : int
+        Number of histogram bins
+    quantiles : list of float
+        Percentiles to report, between 0 and 100
+
+    Returns
+    -------
+    tuple
+        Bin counts with one row per group, the shared bin edges, and one
+        compute_stats style dict per group (None for empty groups)
+    """
+    edges = np.histogram_bin_edges(values, bins=bins)
+    idx = np.minimum(np.searchsorted(edges, values, side='right') - 1, bins - 1)
+    counts = np.bincount(codes * bins + idx, minlength=n_groups * bins).reshape(n_groups, bins)
+    n = np.bincount(codes, minlength=n_groups)
+    safe_n = np.maximum(n, 1)
+    mean = np.bincount(codes, weights=values, minlength=n_groups) / safe_n
+    var = np.bincount(codes, weights=(values - mean[codes])**2, minlength=n_groups) / safe_n
+    # Sorting by group, then value, puts each group's order statistics in
+    # one contiguous run, so every quantile of every group is an index
+    ordered = values[np.lexsort((values, codes))]
+    start = np.cumsum(n) - n
+    positions = start[:, None] + np.asarray(quantiles, dtype=np.float64) / 100 * (safe_n - 1)[:, None]
+    lo = np.floor(positions).astype(np.int64)
+    hi = np.ceil(positions).astype(np.int64)
+    q = ordered[lo] + (ordered[hi] - ordered[lo]) * (positions - lo)
+    minimum = ordered[start]
+    maximum = ordered[start + safe_n - 1]
+    stats = []
+    for g in range(n_groups):
+        if n[g] == 0:
+            stats.append(None)
+            continue
+        stats.append({'count': int(n[g]), 'min': float(minimum[g]), 'max': float(maximum[g]),
+                      'mean': float(mean[g]), 'stdev': float(np.sqrt(var[g])),
+                      'quantiles': {p: float(v) for p, v in zip(quantiles, q[g])}})
+    return counts, edges, stats
+
+def format_stats(stats):
+    """Formats the output of compute_stats as lines of text"""
+    lines = ["{:<8}{: 1g}".format(label + ":", stats[key]) for label, key in
+             [("Min", 'min'), ("Max", 'max'), ("Mean", 'mean'), ("Stdev", 'stdev')]]
+    quantiles = stats['quantiles']
+    if 50 in quantiles:
+        lines.append("Median: {: 1g}".format(quantiles[50]))
+    lines.extend("{:<8}{: 1g}".format("P{:g}:".format(p), v) for p, v in quantiles.items() if p != 50)
+    lines.append("Count:  {: 4d}".format(stats['count']))
+    if 'weight' in stats:
+        lines.append("Weight: {: 1g}".format(stats['weight']))
+    return "\n".join(lines)
+
+def stats_json(label, histogram, stats):
+    """A JSON-serializable record of one column's histogram and stats"""
+    record = dict(stats, **label)
+    record['quantiles'] = {"{:g}".format(p): v for p, v in stats['quantiles'].items()}
+    record['histogram'] = {'counts': histogram.h[0].tolist(), 'edges': histogram.h[1].tolist()}
+    return record
+
+def follow(args):
+    """
+    Reads values from a growing file or stdin and redraws the histogram
+    every args.refresh seconds until the input is closed.
+    """
+    reader = ColumnReader(args.file, columns=args.column, sep=args.sep, header=args.header)
+    source = sys.stdin.buffer if args.file == '-' else open(args.file, 'rb')
+    fd = source.fileno()
+    regular_file = stat.S_ISREG(os.fstat(fd).st_mode)
+    window = None
+    pending = []
+    next_draw = time.monotonic()
+    closed = False
+    while not closed:
+        timeout = max(0.0, next_draw - time.monotonic())
+        if regular_file:
+            # A file at EOF may still grow, so wait and try again like tail -f
+            chunk = os.read(fd, 1<<20)
+            if not chunk:
+                time.sleep(timeout)
+        elif select.select([fd], [], [], timeout)[0]:
+            chunk = os.read(fd, 1<<20)
+            closed = not chunk
+        else:
+            chunk = b''
+        values = (reader.feed(chunk) if not closed else reader.flush())[:, 0]
+        if window is None:
+            pending.append(values)
+        else:
+            window.update(values)
+        if time.monotonic() < next_draw and not closed:
+            continue
+        next_draw = time.monotonic() + args.refresh
+        if window is None:
+            # Without --range the bins are fixed from the values seen before the first frame
+            values = np.concatenate(pending)
+            if values.size == 0:
+                continue
+            lo, hi = args.range if args.range is not None else (values.min(), values.max())
+            if lo == hi:
+                lo, hi = lo - 0.5, hi + 0.5
+            window = RollingWindow(np.linspace(lo, hi, 31), max_count=args.window_count, max_age=args.window_seconds)
+            window.update(values)
+            pending = None
+        window.evict()
+        sys.stdout.write("\x1b[H\x1b[2J" + render_window(window, reader, args.quantiles))
+        sys.stdout.flush()
+    source.close()
+
+def render_window(window, reader, quantiles):
+    """Returns one frame of follow mode output as a single string"""
+    frame = [window.histogram().vertical(120)]
+    stats = window.stats(quantiles)
+    if stats is not None:
+        frame.append(format_stats(stats))
+    else:
+        frame.append("No values in the current window.")
+    frame.append("Outside range: {: 4d}".format(window.out_of_range))
+    if reader.malformed:
+        frame.append("Malformed lines: {}".format(reader.malformed))
+    return "\n".join(frame) + "\n"
+
+def group_results(column, values, codes, group_names, args):
+    """Per-group results for one column, largest groups first"""
+    counts, edges, stats = group_stats(values, codes, len(group_names), bins=30, quantiles=args.quantiles)
+    order = np.argsort(-counts.sum(axis=1), kind='stable')
+    if args.top is not None:
+        order = order[:args.top]
+    return [({'column': column, 'group': group_names[g]}, Histogram.from_counts(counts[g], edges), stats[g], [])
+            for g in order if stats[g] is not None]
+
+def main(args):
+    if args.benchmark:
+        benchmark(args)
+        return
+    if args.follow:
+        try:
+            follow(args)
+        except KeyboardInterrupt:
+            pass
+        return
+    files = args.files
+    results = []
+    if len(files) > 1 or args.stream:
+        if len(files) > 1:
+            summaries = summarize_files(files, args)
+        elif args.file:
+            summaries, reader = summarize_file(args.file, args.column, args.sep, args.header, args.range)
+            reader.report()
+        else:
+            summaries = [StreamSummary(bins=30, value_range=args.range)]
+            summaries[0].update(read_columns(args)[0][:, 0])
+        if summaries[0].stats.n == 0:
+            sys.exit("No data found in the input.")
+        for column, summary in zip(args.column, summaries):
+            if args.range is not None:
+                notes = ["Outside range: {: 4d}".format(summary.out_of_range)]
+            else:
+                notes = ["(Histogram estimated from the quantile sketch)"]
+            notes.append("(Quantiles from a KLL sketch with k={}; rank error about 1.7%)".format(summary.sketch.k))
+            results.append(({'column': column}, summary.histogram(), summary.result(args.quantiles), notes))
     else:
-        data = [float(x) for x in args.data]
-    lenrange = int(np.max(data) - np.min(data))
-    h = Histogram(data, bins=30)
-    print(h.vertical(120))
-    print("")
-    print("Min:    {: 1g}".format(np.min(data)))
-    print("Max:    {: 1g}".format(np.max(data)))
-    print("Mean:   {: 1g}".format(np.mean(data)))
-    print("Stdev:  {: 1g}".format(np.std(data)))
-    print("Median: {: 1g}".format(np.median(data)))
-    print("P10:    {: 1g}".format(np.percentile(data, 10)))
-    print("P25:    {: 1g}".format(np.percentile(data, 25)))
-    print("P75:    {: 1g}".format(np.percentile(data, 75)))
-    print("P90:    {: 1g}".format(np.percentile(data, 90)))
-    print("Count:  {: 4d}".format(len(data)))
+        data, group_names = read_columns(args)
+        if data.size == 0:
+            sys.exit("No data found in the input.")
+        weights = data[:, len(args.column)] if args.weight_column else None
+        if weights is not None and (weights < 0).any():
+            sys.exit("Weights must not be negative.")
+        if weights is not None and not weights.sum() > 0:
+            sys.exit("Weights must not all be zero.")
+        for j, column in enumerate(args.column):
+            values = data[:, j]
+            if args.group_column:
+                results.extend(group_results(column, values, data[:, -1].astype(np.int64), group_names, args))
+                continue
+            stats = compute_stats(values, weights, args.quantiles)
+            h = Histogram(values, bins=30, range=(stats['min'], stats['max']), weights=weights)
+            results.append(({'column': column}, h, stats, []))
+    if args.json:
+        print(json.dumps([stats_json(label, h, stats) for label, h, stats, notes in results], indent=2))
+        return
+    for label, h, stats, notes in results:
+        if len(results) > 1:
+            print("="*40)
+            print(", ".join("{} {}".format(k.capitalize(), v) for k, v in label.items()))
+            print("-"*40)
+        print(h.vertical(120))
+        print("")
+        print(format_stats(stats))
+        for note in notes:
+            print(note)
 
 if __name__ == "__main__":
     desc = ("Takes in one-dimensional numeric data and constructs an ASCII histogram plot.")
     parser = argparse.ArgumentParser(description=desc)
     input_sources = parser.add_mutually_exclusive_group(required=True)
     input_sources.add_argument("--data", nargs='+', help="A list of numbers to construct the histogram from.")
-    input_sources.add_argument("--file", help="A file containing at least one column of numeric data.")
+    input_sources.add_argument("--file", help="A file containing at least one column of numeric data, or a quoted glob matching several such files. Use - to read from stdin.")
     file_options = parser.add_argument_group(title="File options")
-    file_options.add_argument("--column", type=int, default=1, help="The column of the file to construct the histogram from. Default: 1")
+    file_options.add_argument("--column", type=int, nargs='+', default=[1], help="The column(s) of the file to construct histograms from. Each file is read once for all columns. Default: 1")
+    file_options.add_argument("--jobs", type=int, default=os.cpu_count(), help="Number of worker processes used when --file matches several files. Quantiles are then estimated with a KLL sketch. Default: number of CPUs")
+    file_options.add_argument("--weight-column", type=int, help="A column of non-negative weights for each value.")
+    file_options.add_argument("--group-column", type=int, help="A column of category labels. One histogram is drawn per label, sharing the same bins.")
+    file_options.add_argument("--top", type=int, help="With --group-column, only show the N largest groups.")
     file_options.add_argument("--sep", default='\t', help="The column separator in the input file. Default: TAB")
     file_options.add_argument("--header", type=int, default=0, help="The number of header lines at the top of the file. Default: 0")
+    file_options.add_argument("--benchmark", action='store_true', help="Time the chunked file parser against the line-by-line parser and exit.")
+    output_options = parser.add_argument_group(title="Output options")
+    output_options.add_argument("--quantiles", type=float, nargs='+', default=QUANTILES, help="Percentiles to report. Default: %(default)s")
+    output_options.add_argument("--json", action='store_true', help="Print the histogram counts and stats as JSON instead of text.")
+    stream_options = parser.add_argument_group(title="Streaming options")
+    stream_options.add_argument("--stream", action='store_true', help="Read the input in one pass with fixed memory. Min, max, mean and stdev are exact; quantiles come from a KLL sketch.")
+    stream_options.add_argument("--range", type=float, nargs=2, metavar=('MIN', 'MAX'), help="Fixed histogram range for --stream and --follow. Bin counts are exact inside this range. Default: estimate the range from the data")
+    follow_options = parser.add_argument_group(title="Follow options")
+    follow_options.add_argument("--follow", action='store_true', help="Keep reading --file (or stdin with --file -) as it grows and redraw the histogram periodically.")
+    follow_options.add_argument("--refresh", type=float, default=1.0, help="Seconds between redraws in --follow mode. Default: %(default)s")
+    window = follow_options.add_mutually_exclusive_group()
+    window.add_argument("--window-count", type=int, help="Only show the most recent N values.")
+    window.add_argument("--window-seconds", type=float, help="Only show values that arrived in the last N seconds.")
     args = parser.parse_args()
-    if args.file and not os.path.isfile(args.file):
-        sys.exit("The specified file does not exist: {}".format(args.file))
+    args.files = expand_files(args.file) if args.file else []
+    if args.file and not args.files:
+        sys.exit("No files match the specified path: {}".format(args.file))
+    if len(args.files) == 1:
+        # Every single-file path below opens args.file, so give it the match
+        args.file = args.files[0]
+    if len(args.files) > 1 and (args.follow or args.benchmark):
+        sys.exit("--follow and --benchmark take a single file.")
+    if args.follow and len(args.column) > 1:
+        sys.exit("--follow takes a single column.")
+    if args.benchmark and not args.file:
+        sys.exit("--benchmark requires --file.")
+    if args.follow and not args.file:
+        sys.exit("--follow requires --file.")
+    if args.follow and len(args.sep.encode()) != 1:
+        sys.exit("--follow requires a single-character separator.")
+    if args.weight_column and (args.data or args.stream or args.follow or len(args.files) > 1):
+        sys.exit("--weight-column only works with a single --file and without --stream or --follow.")
+    if args.group_column and (args.data or args.stream or args.follow or args.weight_column or len(args.files) > 1):
+        sys.exit("--group-column only works with a single --file and without --stream, --follow or --weight-column.")
+    if any(p < 0 or p > 100 for p in args.quantiles):
+        sys.exit("Quantiles must be between 0 and 100.")
+    if args.range is not None and not args.range[0] < args.range[1]:
+        sys.exit("The histogram range must have MIN < MAX.")
     main(args)
 
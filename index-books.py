@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 import os
 import sys
+import json
+import time
+import logging
 import argparse
 import pandas as pd
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 def make_lalign_formatter(df, cols=None):
     """
@@ -74,6 +78,180 @@ def parse_filename(filename):
         author, series, title = fields
     return (author, title, series, ext)
 
+def scan_directory(path, previous=None):
+    """
+    List one directory, using the file type information that scandir
+    returns with each entry so no extra stat calls are needed.
+
+    Arguments
+    ---------
+    path: str
+        The directory to list
+    previous: dict or None
+        The listing from the last run. If the directory's mtime hasn't
+        changed since, it is returned as is instead of listing again.
+
+    Returns
+    -------
+    dict
+        The directory's mtime_ns and lists of the names of its files and
+        subdirectories
+    """
+    try:
+        # Stat before listing so a change made during the listing shows up next time
+        mtime = os.stat(path).st_mtime_ns
+    except OSError as e:
+        print("Skipping unreadable directory {}: {}".format(path, e), file=sys.stderr)
+        return {'mtime_ns': None, 'files': [], 'subdirs': []}
+    if previous is not None and previous['mtime_ns'] == mtime:
+        return previous
+    files, subdirs = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                # Don't descend into symlinked directories, which could loop
+                if entry.is_dir() and not entry.is_symlink():
+                    subdirs.append(entry.name)
+                else:
+                    files.append(entry.name)
+    except OSError as e:
+        print("Skipping unreadable directory {}: {}".format(path, e), file=sys.stderr)
+        mtime = None
+    return {'mtime_ns': mtime, 'files': files, 'subdirs': subdirs}
+
+def walk_library(top, jobs=8, previous=None):
+    """
+    Arguments
+    ---------
+    top: str
+        The top level Books directory
+    jobs: int
+        Number of directories to list at once
+    previous: dict or None
+        Directory listings from the last run, keyed on the path below
+        top, as returned by this function. Directories whose mtime hasn't
+        changed are not listed again.
+
+    Returns
+    -------
+    tuple
+        A dict mapping the name of each subdirectory of top (one per
+        sheet) to a sorted list of the files below it, each given as a
+        tuple of the folder names under the sheet folder followed by the
+        file name, and a dict of the directory listings for the next run
+    """
+    previous = previous or {}
+    sheets = {}
+    with os.scandir(top) as it:
+        for entry in it:
+            # Symlinked sheet folders are fine at the top level
+            if entry.is_dir():
+                sheets[entry.name] = []
+    directories = {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        def submit(parts):
+            key = "/".join(parts)
+            pending[pool.submit(scan_directory, os.path.join(top, *parts), previous.get(key))] = parts
+        pending = {}
+        for sheet in sheets:
+            submit((sheet,))
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                parts = pending.pop(future)
+                listing = future.result()
+                directories["/".join(parts)] = listing
+                sheets[parts[0]].extend(parts[1:] + (f,) for f in listing['files'])
+                for d in listing['subdirs']:
+                    submit(parts + (d,))
+    for files in sheets.values():
+        files.sort()
+    return sheets, directories
+
+def build_sheet(sheet, files):
+    """
+    Arguments
+    ---------
+    sheet: str
+        The name of the sheet (its top level folder)
+    files: list
+        The files in the sheet, as returned by walk_library
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        One row per file, indexed on Filename. Files in nested folders
+        get Category, Field and Subfield from the first, second and
+        remaining folder names, and their Filename is the path below
+        the sheet folder so it stays unique.
+    """
+    # Start with the basic columns so an empty folder still makes a sheet
+    data = defaultdict(list, {col: [] for col in ['Filename', 'Type', 'Author(s)', 'Title']})
+    nested = any(len(parts) > 1 for parts in files)
+    for parts in files:
+        # Parse file names
+        (author, title, series, ext) = parse_filename(parts[-1])
+        # Add to the data dictionary
+        data['Filename'].append("/".join(parts)) # Used as an index to compare entries
+        data['Type'].append(ext)
+        data['Author(s)'].append(author)
+        data['Title'].append(title)
+        if sheet == 'Novels': # I only care about series for novels
+            data['Series'].append(series)
+        if nested:
+            folders = parts[:-1]
+            data['Category'].append(folders[0] if len(folders) > 0 else "")
+            data['Field'].append(folders[1] if len(folders) > 1 else "")
+            data['Subfield'].append("/".join(folders[2:]))
+    # Every derived column is text, including those of an empty sheet
+    return pd.DataFrame(data, dtype=str).set_index('Filename', drop=False)
+
+def file_signature(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_manifest(path, directories, sheets, outfile):
+    """
+    Write the sidecar manifest: the directory listings, and for each
+    sheet its Filenames with the values of any columns that can't be
+    worked out from the file name (Importance, Enthusiasm, Read?...).
+    The index's size and mtime are kept so a later run can tell whether
+    it was edited since.
+    """
+    manifest = {'index': file_signature(outfile), 'directories': directories, 'sheets': {}}
+    for sheet, df in sheets.items():
+        derived = build_sheet(sheet, [tuple(f.split('/')) for f in df.index]).columns
+        extra = [col for col in df.columns if col not in derived]
+        # One entry per file, even when there are no extra columns to keep
+        values = df[extra].to_numpy(dtype=object)
+        manifest['sheets'][sheet] = {
+                filename: {col: (None if pd.isna(value) else value) for col, value in zip(extra, row)}
+                for filename, row in zip(df.index, values)
+                }
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f:
+        # numpy numbers from the sheets go through default=
+        json.dump(manifest, f, default=lambda value: value.item() if hasattr(value, 'item') else str(value))
+    os.replace(tmp, path)
+
+def sheets_from_manifest(manifest):
+    """Rebuild the index sheets recorded in a manifest without reading the spreadsheet"""
+    sheets = {}
+    for sheet, rows in manifest['sheets'].items():
+        df = build_sheet(sheet, [tuple(f.split('/')) for f in rows])
+        extra = {col for values in rows.values() for col in values}
+        for col in sorted(extra):
+            df[col] = [rows[f].get(col) for f in df.index]
+        sheets[sheet] = df
+    return sheets
+
 def write_index(sheets, outfile):
     """
     Arguments
@@ -224,30 +402,33 @@ def write_index(sheets, outfile):
                                                                                         'format': bad_fmt})
 
 def main(args):
-    # Get the subdirectories of the top level directory
     TLD = os.path.abspath(args.directory)
-    contents = [os.path.join(TLD, entry) for entry in os.listdir(TLD)]
-    dirs = [d for d in contents if os.path.isdir(d)]
-    # Go through each subdirectory to populate sheets
-    sheets = {}
-    for d in dirs:
-        data = defaultdict(list)
-        files = os.listdir(d)
-        for f in files:
-            # Parse file names
-            (author, title, series, ext) = parse_filename(f)
-            # Add to the data dictionary
-            data['Filename'].append(f) # Used as an index to compare entries
-            data['Type'].append(ext)
-            data['Author(s)'].append(author)
-            data['Title'].append(title)
-            if os.path.basename(d) == 'Novels': # I only care about series for novels
-                data['Series'].append(series)
-        sheets[os.path.basename(d)] = pd.DataFrame(data).set_index('Filename', drop=False)
-    # If an existing index was provided...
-    if args.index is not None:
-        # Read in the old index data
+    outfile = os.path.join(TLD, args.output + ".xlsx")
+    manifest_path = os.path.join(TLD, args.output + ".manifest.json")
+    manifest = None if args.no_manifest else load_manifest(manifest_path)
+    # Walk the subdirectories of the top level directory to populate sheets
+    previous = manifest['directories'] if manifest else {}
+    library, directories = walk_library(TLD, args.jobs, previous)
+    if previous:
+        listed = sum(1 for key, listing in directories.items() if listing is not previous.get(key))
+        print("Listed {} of {} directories; the rest are unchanged since the last run.".format(listed, len(directories)))
+    sheets = {sheet: build_sheet(sheet, files) for sheet, files in library.items()}
+    # Find the previous index: the manifest if the spreadsheet hasn't been
+    # edited since it was written, else the spreadsheet itself
+    old_index = None
+    in_place = False
+    if args.index is not None and (manifest is None or os.path.abspath(args.index) != outfile):
         old_index = pd.read_excel(args.index, sheet_name=None)
+    elif manifest is not None and os.path.exists(outfile):
+        in_place = True
+        if file_signature(outfile) == manifest['index']:
+            old_index = sheets_from_manifest(manifest)
+        else:
+            print("{} was edited since the last run; reading it.".format(outfile))
+            old_index = pd.read_excel(outfile, sheet_name=None)
+    changed = not in_place
+    # If an existing index was provided...
+    if old_index is not None:
         # Reindex the DataFrame on unique file names
         for sheet, df in old_index.items():
             old_index[sheet] = df.set_index('Filename', drop=False)
@@ -263,27 +444,27 @@ def main(args):
                 merged[x] = old_index[x]
                 print("Directory '{}' not found. Sheet preserved from old index.".format(x))
                 print("\tFormer contents:")
-                print_changed_files(merged[x], cols=['Filename'])
+                print_changed_files(merged[x][['Filename']], cols=['Filename'])
             elif x not in old_index:
                 merged[x] = sheets[x]
-                changes = sheets[x]
+                changed = True
                 print("New directory '{}' found. Sheet added to index.".format(x))
                 print("\tContents:")
-                print_changed_files(merged[x], cols=['Filename'])
+                print_changed_files(merged[x][['Filename']], cols=['Filename'])
             else:
                 merged[x] = sheets[x].combine_first(old_index[x])
-                changes = pd.merge(sheets[x], old_index[x], how='outer', left_index=True, right_index=True, indicator=True, validate='one_to_one', suffixes=('_l','_r'))
                 print("Found existing directory '{}'.".format(x))
-                added = changes[changes['_merge'] == "left_only"]
-                removed = changes[changes['_merge'] == "right_only"]
-                if not added.empty:
+                added = sorted(set(sheets[x].index) - set(old_index[x].index))
+                removed = sorted(set(old_index[x].index) - set(sheets[x].index))
+                if added:
+                    changed = True
                     print("\tFiles added:")
-                    print_changed_files(added, cols=['Filename_l'])
+                    print_changed_files(sheets[x].loc[added, ['Filename']], cols=['Filename'])
                 else:
                     print("\tNo new files found.")
-                if not removed.empty:
+                if removed:
                     print("\tFiles removed:")
-                    print_changed_files(removed, cols=['Filename_r'])
+                    print_changed_files(old_index[x].loc[removed, ['Filename']], cols=['Filename'])
                 else:
                     print("\tNo removed files identified.")
             print("")
@@ -291,20 +472,217 @@ def main(args):
             print("")
         sheets = merged
     # Write output index to file
-    outfile = os.path.join(TLD, args.output + ".xlsx")
-    write_index(sheets, outfile)
+    if changed:
+        write_index(sheets, outfile)
+    else:
+        print("No new files or directories; {} left as it is.".format(outfile))
+    if not args.no_manifest:
+        save_manifest(manifest_path, directories, sheets, outfile)
     print("Done!")
     print("\tMake sure to check the spreadsheet entries for any sheets or files listed above!")
+    if args.watch:
+        watch(args, TLD, outfile, manifest_path, sheets, directories)
+
+def rescan_directories(top, directories, keys):
+    """
+    Arguments
+    ---------
+    top: str
+        The top level Books directory
+    directories: dict
+        Directory listings as returned by walk_library
+    keys: iterable of str
+        Paths below top of the directories known to have changed, with
+        "" for top itself
+
+    Returns
+    -------
+    dict
+        A copy of directories with the changed directories listed again.
+        Their new subdirectories are walked, and the listings of any that
+        were removed are dropped.
+    """
+    directories = dict(directories)
+    def drop(key):
+        for k in [k for k in directories if k == key or k.startswith(key + "/")]:
+            del directories[k]
+    def walk(key, listing):
+        directories[key] = listing
+        for d in listing['subdirs']:
+            sub = key + "/" + d
+            walk(sub, scan_directory(os.path.join(top, *sub.split("/")), directories.get(sub)))
+        # Subdirectories that have gone
+        for k in [k for k in directories if k.startswith(key + "/") and "/" not in k[len(key) + 1:]]:
+            if k[len(key) + 1:] not in listing['subdirs']:
+                drop(k)
+    for key in set(keys):
+        if key == "":
+            sheets = {entry.name for entry in os.scandir(top) if entry.is_dir()}
+            for sheet in {k.split("/")[0] for k in directories} - sheets:
+                drop(sheet)
+            for sheet in sheets - set(directories):
+                walk(sheet, scan_directory(os.path.join(top, sheet)))
+        elif os.path.isdir(os.path.join(top, *key.split("/"))):
+            walk(key, scan_directory(os.path.join(top, *key.split("/"))))
+        else:
+            drop(key)
+    return directories
+
+def diff_listings(old, new):
+    """
+    Returns
+    -------
+    tuple
+        Lists of the files added and removed between two sets of directory
+        listings, each as a tuple of the sheet, the folders below it and
+        the file name
+    """
+    added, removed = [], []
+    for key in old.keys() | new.keys():
+        if old.get(key) is new.get(key):
+            continue
+        before = set(old[key]['files']) if key in old else set()
+        after = set(new[key]['files']) if key in new else set()
+        parts = tuple(key.split("/"))
+        added.extend(parts + (f,) for f in sorted(after - before))
+        removed.extend(parts + (f,) for f in sorted(before - after))
+    return added, removed
+
+def apply_changes(sheets, added, removed, log):
+    """
+    Add rows for new files to the in-memory sheets and log the changes.
+    As in a normal update, the rows of removed files are kept and only
+    reported. Returns True if any rows were added.
+    """
+    for sheet in sorted({parts[0] for parts in added}):
+        new_rows = build_sheet(sheet, [parts[1:] for parts in added if parts[0] == sheet])
+        if sheet in sheets:
+            sheets[sheet] = new_rows.combine_first(sheets[sheet])
+            log.info("Files added to sheet '%s':\n\t%s", sheet, "\n\t".join(new_rows.index))
+        else:
+            sheets[sheet] = new_rows
+            log.info("New directory '%s' found. Sheet added to index:\n\t%s", sheet, "\n\t".join(new_rows.index))
+    for sheet in sorted({parts[0] for parts in removed}):
+        log.info("Files removed from sheet '%s':\n\t%s", sheet,
+                 "\n\t".join("/".join(parts[1:]) for parts in removed if parts[0] == sheet))
+    return bool(added)
+
+def make_watcher(top, directories):
+    """
+    Set up inotify watches on top and every directory below it. Returns
+    None if inotify isn't available, so the caller can poll instead.
+    """
+    try:
+        from inotify_simple import INotify, flags
+    except ImportError:
+        return None
+    mask = flags.CREATE | flags.DELETE | flags.MOVED_FROM | flags.MOVED_TO | flags.DELETE_SELF | flags.MOVE_SELF
+    watcher = INotify()
+    watcher.paths = {}
+    def add(key):
+        if key not in watcher.paths.values():
+            wd = watcher.add_watch(os.path.join(top, *key.split("/")) if key else top, mask)
+            watcher.paths[wd] = key
+    watcher.add = add
+    try:
+        for key in [""] + list(directories):
+            add(key)
+    except OSError as e:
+        # Usually fs.inotify.max_user_watches is too low for the tree
+        logging.getLogger(__name__).warning("Can't watch the library with inotify (%s); polling instead.", e)
+        watcher.close()
+        return None
+    return watcher
+
+def watch(args, top, outfile, manifest_path, sheets, directories):
+    """
+    Keep the index current until interrupted. Changed directories are
+    found with inotify, or by checking every directory's mtime each
+    interval if inotify isn't available, and listed again once no new
+    events have arrived for args.debounce seconds. New files are added to
+    the in-memory sheets, and the index is rewritten at most once every
+    args.interval seconds. Changes are reported to args.log.
+    """
+    logging.basicConfig(filename=args.log or os.path.join(top, args.output + ".log"),
+                        format="%(asctime)s %(message)s", level=logging.INFO)
+    log = logging.getLogger(__name__)
+    watcher = make_watcher(top, directories)
+    print("Watching {} using {}. Press Ctrl-C to stop.".format(top, "inotify" if watcher else "polling"))
+    log.info("Watching %s using %s", top, "inotify" if watcher else "polling")
+    signature = file_signature(outfile)
+    changed = set()
+    last_event = last_write = time.monotonic()
+    dirty = False
+    try:
+        while True:
+            if watcher is not None:
+                for event in watcher.read(timeout=1000):
+                    if event.wd in watcher.paths:
+                        changed.add(watcher.paths[event.wd])
+                        last_event = time.monotonic()
+                ready = changed and time.monotonic() - last_event >= args.debounce
+            else:
+                time.sleep(args.interval)
+                ready = True
+            if ready:
+                if watcher is not None:
+                    new_directories = rescan_directories(top, directories, changed)
+                    for key in new_directories.keys() - directories.keys():
+                        watcher.add(key)
+                    # Watches on removed directories go away by themselves
+                    for wd in [wd for wd, key in watcher.paths.items() if key and key not in new_directories]:
+                        del watcher.paths[wd]
+                else:
+                    new_directories = walk_library(top, args.jobs, directories)[1]
+                added, removed = diff_listings(directories, new_directories)
+                dirty |= apply_changes(sheets, added, removed, log)
+                dirty |= new_directories != directories and not args.no_manifest
+                directories = new_directories
+                changed = set()
+            if dirty and time.monotonic() - last_write >= args.interval:
+                signature = save_index(args, outfile, manifest_path, sheets, directories, signature, log)
+                last_write = time.monotonic()
+                dirty = False
+    except KeyboardInterrupt:
+        if dirty:
+            save_index(args, outfile, manifest_path, sheets, directories, signature, log)
+        log.info("Stopped watching %s", top)
+
+def save_index(args, outfile, manifest_path, sheets, directories, signature, log):
+    """
+    Write the in-memory sheets to the index, first merging in any edits
+    made to the spreadsheet since it was last written. Returns the new
+    signature of the index.
+    """
+    if os.path.exists(outfile) and file_signature(outfile) != signature:
+        log.info("%s was edited; merging the edits before rewriting it", outfile)
+        edited = pd.read_excel(outfile, sheet_name=None)
+        for sheet, df in edited.items():
+            df = df.set_index('Filename', drop=False)
+            sheets[sheet] = df.combine_first(sheets[sheet]) if sheet in sheets else df
+    write_index(sheets, outfile)
+    if not args.no_manifest:
+        save_manifest(manifest_path, directories, sheets, outfile)
+    log.info("Wrote %s", outfile)
+    return file_signature(outfile)
 
 if __name__ =="__main__":
     desc = ("Indexes the contents of the provided Books directory. The spreadsheet "
             "output will be placed in the provided directory. One sheet will be created "
             "for each subfolder of the top level Books directory. If an existing index "
-            "is provided, the contents will be updated with any new additions.")
+            "is provided, the contents will be updated with any new additions. A manifest "
+            "kept next to the index lets later runs update it without re-reading the "
+            "spreadsheet or relisting unchanged directories.")
     epil = "Depends on the openpyxl and xlsxwriter packages."
     parser = argparse.ArgumentParser(description=desc, epilog=epil)
     parser.add_argument('-i', '--index', help="Path to existing index to update.")
     parser.add_argument('-o', '--output', default="Index", help="Name for the output index file. Default: Index")
+    parser.add_argument('-j', '--jobs', type=int, default=8, help="Number of directories to list at once. Default: 8")
+    parser.add_argument('--no-manifest', action='store_true', help="Don't read or write the manifest, so the index is only updated from --index.")
+    parser.add_argument('-w', '--watch', action='store_true', help="After updating the index, keep running and add new files to it as they arrive. Uses inotify if the inotify_simple package is installed, else polls.")
+    parser.add_argument('--interval', type=float, default=60, help="With --watch, the shortest time in seconds between rewrites of the index, and the polling period. Default: 60")
+    parser.add_argument('--debounce', type=float, default=5, help="With --watch, wait until no changes have been seen for this many seconds before reading changed directories. Default: 5")
+    parser.add_argument('--log', help="With --watch, log the files added and removed here. Default: <output>.log in the Books directory")
     parser.add_argument('directory', help="Top level Books directory to index.")
     args = parser.parse_args()
     if not os.path.isdir(args.directory):
@@ -1,25 +1,502 @@
 #!/usr/bin/env python
+import io
 import os
+import math
+import re
+import csv
 import sys
+import glob
+import heapq
+import bisect
+import pickle
+import hashlib
+import shutil
 import argparse
+import tempfile
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 
 def main(args):
-    df1 = pd.read_csv(args.CSV1, sep=args.sep, index_col=0)
-    df2 = pd.read_csv(args.CSV2, sep=args.sep, index_col=0)
+    if args.delta is not None:
+        delta_merge(args)
+        return
+    if args.max_memory is not None:
+        external_merge(args)
+        return
+    if len(args.CSV) > 2 or args.jobs is not None:
+        partitioned_merge(args)
+        return
+    df1 = read_csv_cached(args.CSV[0], args.cache_dir, args.cache_size, sep=args.sep, index_col=0)
+    df2 = read_csv_cached(args.CSV[1], args.cache_dir, args.cache_size, sep=args.sep, index_col=0)
     out = pd.merge(df1, df2, how='outer', left_index=True, right_index=True, suffixes=('_l', '_r'), validate='one_to_one')
     out.to_csv(args.out, sep='\t', index_label='index')
 
+def parse_size(text):
+    """Converts a size such as 512M or 2G to a number of bytes"""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d*)?)\s*([KMGT]?)B?\s*', text.upper())
+    if match is None:
+        raise argparse.ArgumentTypeError("Invalid size: {}".format(text))
+    number, unit = match.groups()
+    return int(float(number) * 1024**'_KMGT'.index(unit or '_'))
+
+def read_csv_cached(path, cache_dir, cache_size, **options):
+    """
+    pd.read_csv with an optional Arrow sidecar cache in `cache_dir`.
+    Cached copies are keyed on the file's path, size and mtime and the
+    read options, so a copy is replaced as soon as its source changes.
+    Cached files are memory-mapped when read back.
+    """
+    if cache_dir is None:
+        return pd.read_csv(path, **options)
+    import pyarrow.feather as feather
+    st = os.stat(path)
+    source = hashlib.sha1(repr((os.path.abspath(path), sorted(options.items()))).encode()).hexdigest()[:16]
+    version = hashlib.sha1(repr((st.st_size, st.st_mtime_ns)).encode()).hexdigest()[:16]
+    cached = os.path.join(cache_dir, '{}-{}.arrow'.format(source, version))
+    try:
+        df = feather.read_table(cached, memory_map=True).to_pandas()
+        # Touch the entry so that eviction removes the least recently used first
+        os.utime(cached)
+        return df
+    except (FileNotFoundError, OSError):
+        pass
+    df = pd.read_csv(path, **options)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Drop copies made from older versions of the same file
+    for old in glob.glob(os.path.join(cache_dir, source + '-*.arrow')):
+        remove_quietly(old)
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+    os.close(fd)
+    feather.write_feather(df, tmp, compression='uncompressed')
+    os.replace(tmp, cached)
+    evict_cache(cache_dir, cache_size)
+    return df
+
+def evict_cache(cache_dir, cache_size):
+    """Deletes the least recently used cache entries until the cache fits in cache_size bytes"""
+    entries = []
+    for path in glob.glob(os.path.join(cache_dir, '*.arrow')):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= cache_size:
+            break
+        remove_quietly(path)
+        total -= size
+
+def remove_quietly(path):
+    # Another process sharing the cache may have removed it already
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def sort_key(key):
+    """Orders numeric keys numerically and before any text keys"""
+    try:
+        number = float(key)
+    except ValueError:
+        return (1, 0.0, key)
+    # nan doesn't compare, so nan and inf keys are ordered as text
+    if not math.isfinite(number):
+        return (1, 0.0, key)
+    return (0, number, '')
+
+def open_rows(path, sep):
+    """Returns the header and a row iterator for a delimited file"""
+    f = open(path, 'r', newline='')
+    if sep is None:
+        # Match pandas' sep=None behaviour by sniffing the delimiter
+        sep = csv.Sniffer().sniff(f.read(65536)).delimiter
+        f.seek(0)
+    # pandas skips blank lines, which the csv module returns as empty rows
+    reader = (row for row in csv.reader(f, delimiter=sep) if row)
+    header = next(reader, [])
+    return header, reader
+
+def is_sorted(path, sep):
+    """Checks whether a file's rows are already in key order"""
+    header, rows = open_rows(path, sep)
+    previous = None
+    for row in rows:
+        key = sort_key(row[0])
+        if previous is not None and key < previous:
+            return False
+        previous = key
+    return True
+
+def spill_runs(rows, max_memory, tmpdir):
+    """
+    Sorts `rows` in batches that fit in `max_memory` bytes and writes each
+    batch to a temporary file. Returns the paths of the sorted runs.
+    """
+    runs = []
+    batch = []
+    size = 0
+    for row in rows:
+        batch.append(row)
+        # Rough in-memory size of a list of short strings
+        size += 64 + sum(len(field) + 56 for field in row)
+        if size >= max_memory:
+            runs.append(write_run(batch, tmpdir))
+            batch = []
+            size = 0
+    if batch:
+        runs.append(write_run(batch, tmpdir))
+    return runs
+
+def write_run(batch, tmpdir):
+    batch.sort(key=lambda row: sort_key(row[0]))
+    fd, path = tempfile.mkstemp(suffix='.csv', dir=tmpdir)
+    with os.fdopen(fd, 'w', newline='') as f:
+        csv.writer(f).writerows(batch)
+    return path
+
+def read_run(path):
+    with open(path, 'r', newline='') as f:
+        yield from csv.reader(f)
+
+def sorted_rows(path, sep, max_memory, tmpdir):
+    """Returns the header and an iterator over the rows of a file in key order"""
+    if is_sorted(path, sep):
+        return open_rows(path, sep)
+    header, rows = open_rows(path, sep)
+    runs = spill_runs(rows, max_memory, tmpdir)
+    return header, heapq.merge(*[read_run(run) for run in runs], key=lambda row: sort_key(row[0]))
+
+def merge_join(streams, names):
+    """
+    Outer join of key-ordered row iterators. Yields (key, rows) with one
+    entry per stream, None where that stream has no row for the key.
+    Exits if any stream repeats a key, like pandas' validate='one_to_one'.
+    """
+    def unique(rows, name):
+        previous = None
+        for row in rows:
+            key = sort_key(row[0])
+            if key == previous:
+                sys.exit("Merge keys are not unique in {}; not a one-to-one merge: {}".format(name, row[0]))
+            previous = key
+            yield key, row
+    streams = [unique(rows, name) for rows, name in zip(streams, names)]
+    heads = [next(s, None) for s in streams]
+    while any(h is not None for h in heads):
+        key = min(h[0] for h in heads if h is not None)
+        rows = [None] * len(heads)
+        for i, h in enumerate(heads):
+            if h is not None and h[0] == key:
+                rows[i] = h[1]
+                heads[i] = next(streams[i], None)
+        yield next(r[0] for r in rows if r is not None), rows
+
+def file_suffixes(n):
+    """Suffixes for shared column names: _l/_r for two files, else _1, _2, ..."""
+    return ['_l', '_r'] if n == 2 else ['_{}'.format(i) for i in range(1, n + 1)]
+
+def suffixed_columns(headers, suffixes):
+    """
+    Adds each file's suffix to its column names that also appear in
+    another file, as pd.merge does for two files
+    """
+    seen = {}
+    for header in headers:
+        for c in set(header):
+            seen[c] = seen.get(c, 0) + 1
+    return [[c + suffix if seen[c] > 1 else c for c in header] for header, suffix in zip(headers, suffixes)]
+
+def external_merge(args):
+    """
+    Outer merge of the input files on their first column using at most
+    about args.max_memory bytes. Unsorted inputs are sorted into
+    temporary spill files first, then all are merge-joined in one pass.
+    """
+    # Each input is sorted on its own, so each can use the full budget
+    with tempfile.TemporaryDirectory(dir=args.temp_dir) as tmpdir:
+        headers, streams = zip(*[sorted_rows(f, args.sep, args.max_memory, tmpdir) for f in args.CSV])
+        columns = suffixed_columns([h[1:] for h in headers], file_suffixes(len(headers)))
+        blanks = [[''] * len(c) for c in columns]
+        writer = csv.writer(args.out, delimiter='\t', lineterminator='\n')
+        writer.writerow(['index'] + [c for cols in columns for c in cols])
+        for key, rows in merge_join(streams, args.CSV):
+            out = [key]
+            for row, blank in zip(rows, blanks):
+                out.extend(row[1:] if row is not None else blank)
+            writer.writerow(out)
+
+def key_order(index):
+    """Positions that put an index in sort_key order without a Python sort"""
+    numbers = pd.to_numeric(pd.Series(index), errors='coerce')
+    # Like sort_key, order nan and inf as text
+    numbers = numbers.where(np.isfinite(numbers))
+    keys = pd.DataFrame({'text': numbers.isna(), 'number': numbers.fillna(0), 'key': list(index)})
+    return keys.sort_values(['text', 'number', 'key'], kind='stable').index.to_numpy()
+
+def partition_file(path, sep, n_partitions, tmpdir, file_number, cache_dir=None, cache_size=0):
+    """
+    Parses one input as text and splits its rows into hash partitions of
+    the index, saved as pickles. Returns the file's column names.
+    Runs in a worker process.
+    """
+    df = read_csv_cached(path, cache_dir, cache_size, sep=sep, index_col=0, dtype=str,
+                         keep_default_na=False, engine='python' if sep is None else 'c')
+    if not df.index.is_unique:
+        raise ValueError("Merge keys are not unique in {}; not a one-to-one merge".format(path))
+    partition = pd.util.hash_pandas_object(df.index, index=False).to_numpy() % n_partitions
+    for p, part in df.groupby(partition):
+        part.to_pickle(os.path.join(tmpdir, 'part{}_file{}.pkl'.format(p, file_number)))
+    return list(df.columns)
+
+def join_partition(p, columns, tmpdir):
+    """
+    Outer-joins partition `p` of every file and writes it as TSV rows
+    sorted by index. Runs in a worker process.
+    """
+    frames = []
+    for i, names in enumerate(columns):
+        path = os.path.join(tmpdir, 'part{}_file{}.pkl'.format(p, i))
+        df = pd.read_pickle(path) if os.path.exists(path) else pd.DataFrame(columns=names, dtype=str)
+        df.columns = names
+        frames.append(df)
+    out = pd.concat(frames, axis=1, join='outer')
+    out = out.iloc[key_order(out.index)]
+    path = os.path.join(tmpdir, 'out{}.tsv'.format(p))
+    out.to_csv(path, sep='\t', header=False)
+    return path
+
+def partitioned_merge(args):
+    """
+    Outer merge of any number of files. Files are parsed in parallel and
+    hash-partitioned on the index, and each partition is joined and
+    sorted in its own process. The sorted partitions are then merged, so
+    the output is in key order whatever the number of jobs.
+    """
+    jobs = args.jobs or os.cpu_count()
+    n = len(args.CSV)
+    with tempfile.TemporaryDirectory(dir=args.temp_dir) as tmpdir, ProcessPoolExecutor(max_workers=jobs) as pool:
+        try:
+            headers = list(pool.map(partition_file, args.CSV, [args.sep]*n, [jobs]*n, [tmpdir]*n, range(n),
+                                    [args.cache_dir]*n, [args.cache_size]*n))
+        except ValueError as e:
+            sys.exit(str(e))
+        columns = suffixed_columns(headers, file_suffixes(n))
+        args.out.write('\t'.join(['index'] + [c for cols in columns for c in cols]) + '\n')
+        paths = list(pool.map(join_partition, range(jobs), [columns]*jobs, [tmpdir]*jobs))
+        rows = heapq.merge(*[read_partition(path) for path in paths], key=lambda row: sort_key(row[0]))
+        csv.writer(args.out, delimiter='\t', lineterminator='\n').writerows(rows)
+
+def read_partition(path):
+    with open(path, 'r', newline='') as f:
+        yield from csv.reader(f, delimiter='\t')
+
+def build_line_index(path):
+    """
+    Scans a merged TSV once and records the key, byte offset and byte
+    length of every data line, in file order
+    """
+    st = os.stat(path)
+    keys = []
+    offsets = []
+    lengths = []
+    in_order = True
+    previous = None
+    with open(path, 'rb') as f:
+        header = f.readline()
+        position = len(header)
+        for line in f:
+            field = line.split(b'\t', 1)[0].rstrip(b'\r\n')
+            key = next(csv.reader([field.decode()]))[0] if field.startswith(b'"') else field.decode()
+            sk = sort_key(key)
+            if previous is not None and sk < previous:
+                in_order = False
+            previous = sk
+            keys.append(key)
+            offsets.append(position)
+            lengths.append(len(line))
+            position += len(line)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'header': header.decode(),
+            'keys': keys, 'offsets': np.array(offsets, dtype=np.int64),
+            'lengths': np.array(lengths, dtype=np.int64), 'sorted': in_order}
+
+def load_line_index(path):
+    """Loads the sidecar index of a merged file, rebuilding it if the file has changed"""
+    index_path = path + '.idx'
+    st = os.stat(path)
+    try:
+        with open(index_path, 'rb') as f:
+            index = pickle.load(f)
+        if index['size'] == st.st_size and index['mtime_ns'] == st.st_mtime_ns:
+            return index
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError, KeyError):
+        pass
+    return build_line_index(path)
+
+def save_line_index(path, index):
+    st = os.stat(path)
+    index['size'], index['mtime_ns'] = st.st_size, st.st_mtime_ns
+    with open(path + '.idx', 'wb') as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def side_columns(header, change_header, side):
+    """
+    Positions in the merged header of a change file's columns, allowing for
+    the _l/_r or _N suffix that side's shared columns were given
+    """
+    suffixes = {1: ['_l', '_1'], 2: ['_r', '_2']}.get(side, ['_{}'.format(side)])
+    positions = []
+    for c in change_header[1:]:
+        candidates = [c + suffix for suffix in suffixes] + [c]
+        matches = [header.index(name) for name in candidates if name in header]
+        if not matches:
+            sys.exit("Column '{}' of side {} is not in the merged file.".format(c, side))
+        positions.append(matches[0])
+    return positions
+
+def format_row(row):
+    buffer = io.StringIO()
+    csv.writer(buffer, delimiter='\t', lineterminator='\n').writerow(row)
+    return buffer.getvalue().encode()
+
+def copy_range(src, dst, start, end):
+    src.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = src.read(min(remaining, 1<<20))
+        if not chunk:
+            break
+        dst.write(chunk)
+        remaining -= len(chunk)
+
+def delta_merge(args):
+    """
+    Upserts changed rows into an existing merged TSV. Only the lines for
+    changed keys are parsed and rewritten; everything between them is
+    copied as raw byte ranges. A sidecar index of line offsets (MERGED.idx)
+    is kept up to date so later runs don't rescan the file.
+    """
+    merged = args.delta
+    index = load_line_index(merged)
+    header = next(csv.reader([index['header'].rstrip('\r\n')], delimiter='\t'))
+    # key -> list of (merged column positions, new values)
+    updates = {}
+    for side, path in args.changes:
+        change_header, rows = open_rows(path, args.sep)
+        positions = side_columns(header, change_header, int(side))
+        for row in rows:
+            updates.setdefault(row[0], []).append((positions, row[1:]))
+    lookup = {key: i for i, key in enumerate(index['keys'])}
+    replaced = sorted((lookup[k], k) for k in updates if k in lookup)
+    added = sorted((k for k in updates if k not in lookup), key=sort_key)
+    offsets, lengths = index['offsets'], index['lengths']
+    # Edits in file order: (offset, bytes removed, new line, key)
+    edits = []
+    with open(merged, 'rb') as f:
+        for i, key in replaced:
+            f.seek(offsets[i])
+            row = next(csv.reader([f.read(lengths[i]).decode().rstrip('\r\n')], delimiter='\t'))
+            row += [''] * (len(header) - len(row))
+            for positions, values in updates[key]:
+                for position, value in zip(positions, values):
+                    row[position] = value
+            edits.append((offsets[i], lengths[i], format_row(row), key))
+    if added:
+        if index['sorted'] and index['keys']:
+            # Keep a key-ordered file in order by inserting before the next larger key
+            existing = [sort_key(k) for k in index['keys']]
+            at = [bisect.bisect_right(existing, sort_key(k)) for k in added]
+        else:
+            at = [len(index['keys'])] * len(added)
+        eof = index['size']
+        for key, i in zip(added, at):
+            row = [key] + [''] * (len(header) - 1)
+            for positions, values in updates[key]:
+                for position, value in zip(positions, values):
+                    row[position] = value
+            edits.append((offsets[i] if i < len(offsets) else eof, 0, format_row(row), key))
+    # Inserts go before a replaced line at the same offset; sorted() is stable
+    edits.sort(key=lambda e: (e[0], e[1] > 0))
+    new_offsets = offsets.copy()
+    new_lengths = lengths.copy()
+    new_keys = []
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(merged)))
+    with open(merged, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+        position = 0
+        for offset, removed, line, key in edits + [(index['size'], 0, b'', None)]:
+            # Lines copied unchanged move by however much the output has grown so far
+            lo, hi = np.searchsorted(offsets, [position, offset])
+            new_offsets[lo:hi] += dst.tell() - position
+            copy_range(src, dst, position, offset)
+            if key is not None:
+                if removed:
+                    i = lookup[key]
+                    new_offsets[i], new_lengths[i] = dst.tell(), len(line)
+                else:
+                    new_keys.append((key, dst.tell(), len(line)))
+                dst.write(line)
+            position = offset + removed
+    shutil.copymode(merged, tmp)
+    os.replace(tmp, merged)
+    keys = index['keys'] + [k for k, o, l in new_keys]
+    all_offsets = np.concatenate([new_offsets, np.array([o for k, o, l in new_keys], dtype=np.int64)])
+    all_lengths = np.concatenate([new_lengths, np.array([l for k, o, l in new_keys], dtype=np.int64)])
+    order = np.argsort(all_offsets, kind='stable')
+    index['keys'] = [keys[i] for i in order]
+    index['offsets'] = all_offsets[order]
+    index['lengths'] = all_lengths[order]
+    save_line_index(merged, index)
+    print("Updated {} row(s) and added {} row(s) in {}".format(len(replaced), len(added), merged), file=sys.stderr)
+
 if __name__ == "__main__":
-    desc = ("Takes in two CSV files and merges based on a common index. The index is assumed to "
-            "be the first column of each file.")
+    desc = ("Takes in two or more CSV files and merges based on a common index. The index is assumed to "
+            "be the first column of each file. Column names found in more than one file get a suffix: "
+            "_l and _r for two files, otherwise _N for the Nth file.")
     parser = argparse.ArgumentParser(description=desc)
-    parser.add_argument('CSV1')
-    parser.add_argument('CSV2')
+    parser.add_argument('CSV', nargs='*', help="Two or more files to merge.")
     parser.add_argument('-s', '--sep')
     parser.add_argument('-o', '--out', nargs='?', default=sys.stdout, type=argparse.FileType('w'))
+    parser.add_argument('-m', '--max-memory', type=parse_size,
+                        help="Merge files larger than memory by sorting them on disk, using roughly this "
+                             "much memory (e.g. 512M, 2G). Values are copied as text rather than parsed "
+                             "by pandas. Rows are ordered by index, numbers first.")
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="Parse the files and join hash partitions of the index in this many processes. "
+                             "Used automatically for more than two files. Values are copied as text and rows "
+                             "are sorted within each partition. Default: number of CPUs")
+    parser.add_argument('--delta', metavar='MERGED',
+                        help="Update an existing merged TSV in place with the rows given by --changes instead "
+                             "of merging CSV files. Unchanged rows are copied without being parsed.")
+    parser.add_argument('--changes', nargs=2, action='append', default=[], metavar=('SIDE', 'FILE'),
+                        help="With --delta, a CSV of new or changed rows for input SIDE (1 for CSV1, 2 for "
+                             "CSV2, ...). May be repeated.")
+    parser.add_argument('--temp-dir', help="Directory for the temporary sort files. Default: system temp directory")
+    parser.add_argument('--cache-dir', default=os.environ.get('MERGE_CSV_CACHE'),
+                        help="Keep a parsed Arrow copy of each input here so later merges of unchanged files "
+                             "skip CSV parsing. Requires pyarrow. Default: $MERGE_CSV_CACHE, else no cache")
+    parser.add_argument('--cache-size', type=parse_size, default=parse_size('10G'),
+                        help="Largest total size of the cache before the least recently used entries are "
+                             "deleted. Default: 10G")
+    parser.add_argument('--no-cache', action='store_true', help="Don't read or write the parse cache.")
     args = parser.parse_args()
-    for f in [args.CSV1, args.CSV2]:
+    if args.no_cache:
+        args.cache_dir = None
+    if args.cache_dir is not None:
+        try:
+            import pyarrow
+        except ImportError:
+            sys.exit("The parse cache requires the pyarrow package.")
+    if args.delta is not None:
+        if args.CSV or not args.changes:
+            sys.exit("--delta takes one or more --changes options and no CSV arguments.")
+        if any(not side.isdigit() or int(side) < 1 for side, path in args.changes):
+            sys.exit("The SIDE of --changes must be a positive number.")
+        args.CSV = [args.delta] + [path for side, path in args.changes]
+    elif len(args.CSV) < 2:
+        sys.exit("At least two files are required.")
+    for f in args.CSV:
         if not os.path.isfile(f):
             sys.exit("Specified file does not exist: {}".format(f))
     main(args)